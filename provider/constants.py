@@ -43,3 +43,93 @@ ENFORCE_CLIENT_SECURE = getattr(settings, 'OAUTH_ENFORCE_CLIENT_SECURE', True)
 SESSION_KEY = getattr(settings, 'OAUTH_SESSION_KEY', 'oauth')
 
 SINGLE_ACCESS_TOKEN = getattr(settings, 'OAUTH_SINGLE_ACCESS_TOKEN', False)
+
+# Back ``SINGLE_ACCESS_TOKEN`` with a unique constraint, so concurrent grants
+# for the same user, client and scope always share one access token.
+ATOMIC_SINGLE_ACCESS_TOKEN = getattr(settings, 'OAUTH_ATOMIC_SINGLE_ACCESS_TOKEN', False)
+
+# Alias of the Django cache (see ``settings.CACHES``) used by the provider.
+CACHE_ALIAS = getattr(settings, 'OAUTH_CACHE_ALIAS', 'default')
+
+# Seconds an access token lookup may be served from the cache. ``0`` disables
+# the cache. Entries never outlive the token itself.
+ACCESS_TOKEN_CACHE_TIMEOUT = getattr(settings, 'OAUTH_ACCESS_TOKEN_CACHE_TIMEOUT', 0)
+
+# Number of access tokens kept in an in-process LRU cache in front of the
+# shared cache, and for how many seconds. A size of ``0`` disables it.
+ACCESS_TOKEN_LOCAL_CACHE_SIZE = getattr(settings, 'OAUTH_ACCESS_TOKEN_LOCAL_CACHE_SIZE', 0)
+ACCESS_TOKEN_LOCAL_CACHE_TIMEOUT = getattr(settings, 'OAUTH_ACCESS_TOKEN_LOCAL_CACHE_TIMEOUT', 5)
+
+# Seconds a lookup for an unknown or expired access token is remembered, so
+# repeated bad tokens do not reach the database. ``0`` disables it.
+ACCESS_TOKEN_NEGATIVE_CACHE_TIMEOUT = getattr(settings, 'OAUTH_ACCESS_TOKEN_NEGATIVE_CACHE_TIMEOUT', 0)
+
+# Issue self-checking access and refresh tokens (see :mod:`provider.tokens`)
+# that can be rejected without a database lookup when forged or expired.
+CHECKED_TOKENS = getattr(settings, 'OAUTH_CHECKED_TOKENS', False)
+
+# Issue signed, self-contained access tokens (see :mod:`provider.tokens`) that
+# resource servers can verify without any I/O. The key defaults to
+# ``settings.SECRET_KEY``.
+SIGNED_TOKENS = getattr(settings, 'OAUTH_SIGNED_TOKENS', False)
+SIGNED_TOKEN_KEY = getattr(settings, 'OAUTH_SIGNED_TOKEN_KEY', None)
+
+# Maximum number of tokens accepted by the batch token detail endpoint.
+TOKEN_BATCH_MAX_SIZE = getattr(settings, 'OAUTH_TOKEN_BATCH_MAX_SIZE', 100)
+
+# Seconds clients and gateways may cache token detail responses. Responses
+# are never cached beyond the token's expiry.
+ACCESS_TOKEN_DETAIL_MAX_AGE = getattr(settings, 'OAUTH_ACCESS_TOKEN_DETAIL_MAX_AGE', 0)
+
+# Seconds clients may be served from the client registry cache, keyed by
+# ``client_id``. ``0`` disables the cache.
+CLIENT_CACHE_TIMEOUT = getattr(settings, 'OAUTH_CLIENT_CACHE_TIMEOUT', 0)
+
+# Number of random bytes in tokens generated by ``provider.utils.long_token``
+# (hex-encoded, so tokens are twice as long). ``None`` keeps the legacy sha1
+# based tokens.
+TOKEN_BYTES = getattr(settings, 'OAUTH_TOKEN_BYTES', None)
+
+# Number of pre-generated tokens kept in memory and refilled by a background
+# thread when ``TOKEN_BYTES`` is set. ``0`` disables the pool.
+TOKEN_POOL_SIZE = getattr(settings, 'OAUTH_TOKEN_POOL_SIZE', 0)
+
+# Seconds during which a refresh token that was already exchanged can be
+# replayed and returns the tokens issued in exchange for it, so a client
+# retrying a timed out refresh is not logged out. ``0`` disables it.
+REFRESH_TOKEN_GRACE_PERIOD = getattr(settings, 'OAUTH_REFRESH_TOKEN_GRACE_PERIOD', 0)
+
+# Seconds a token endpoint response to a request with an ``Idempotency-Key``
+# header is kept, per client, to be replayed for retries of that request.
+# ``0`` disables it.
+IDEMPOTENCY_KEY_TIMEOUT = getattr(settings, 'OAUTH_IDEMPOTENCY_KEY_TIMEOUT', 0)
+
+# Reuse client credentials access tokens for clients with
+# ``reuse_client_credentials_token`` set. While disabled, changed tokens cost
+# no cache round trip to evict.
+CLIENT_CREDENTIALS_TOKEN_REUSE = getattr(settings, 'OAUTH_CLIENT_CREDENTIALS_TOKEN_REUSE', False)
+
+# Fraction of its lifetime that must remain for a client credentials access
+# token to be reused, for clients with ``reuse_client_credentials_token`` set.
+CLIENT_CREDENTIALS_TOKEN_REUSE_THRESHOLD = getattr(settings, 'OAUTH_CLIENT_CREDENTIALS_TOKEN_REUSE_THRESHOLD', 0.5)
+
+# Maximum number of unexpired access tokens per user and client. Issuing a
+# new token expires the oldest ones beyond it. ``0`` means no limit.
+MAX_ACTIVE_ACCESS_TOKENS = getattr(settings, 'OAUTH_MAX_ACTIVE_ACCESS_TOKENS', 0)
+
+# Dotted path of the store for authorization codes, see
+# ``provider.oauth2.stores``.
+GRANT_STORE = getattr(settings, 'OAUTH_GRANT_STORE', 'provider.oauth2.stores.DatabaseGrantStore')
+
+# Dotted path of the store for the state of authorization flows, see
+# ``provider.state``, and the name and lifetime in seconds of the cookie
+# used by the cookie based stores.
+STATE_STORE = getattr(settings, 'OAUTH_STATE_STORE', 'provider.state.SessionStateStore')
+STATE_COOKIE_NAME = getattr(settings, 'OAUTH_STATE_COOKIE_NAME', 'oauth_state')
+STATE_TIMEOUT = getattr(settings, 'OAUTH_STATE_TIMEOUT', 3600)
+
+# Remember the scope a user approved for a client and skip the authorization
+# screen when a later request asks for no more than that. Consents are cached
+# for ``CONSENT_CACHE_TIMEOUT`` seconds, ``0`` disables the cache.
+REMEMBER_CONSENT = getattr(settings, 'OAUTH_REMEMBER_CONSENT', False)
+CONSENT_CACHE_TIMEOUT = getattr(settings, 'OAUTH_CONSENT_CACHE_TIMEOUT', 3600)
@@ -0,0 +1,65 @@
+"""
+Command to compare the speed of the token generators in provider.utils.
+"""
+
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from provider import utils
+
+
+class Command(BaseCommand):
+    """
+    Example usage: ./manage.py benchmark_tokens --iterations 100000
+    """
+    help = 'Compares the speed of the legacy, secrets based and pooled token generators.'
+
+    DEFAULT_ITERATIONS = 10000
+    DEFAULT_BYTES = 20
+    DEFAULT_POOL_SIZE = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--iterations',
+            default=self.DEFAULT_ITERATIONS,
+            type=int,
+            help='Number of tokens to generate per generator.'
+        )
+        parser.add_argument(
+            '--bytes',
+            default=self.DEFAULT_BYTES,
+            type=int,
+            help='Number of random bytes per token for the secrets based generators.'
+        )
+        parser.add_argument(
+            '--pool_size',
+            default=self.DEFAULT_POOL_SIZE,
+            type=int,
+            help='Size of the token pool.'
+        )
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+        if iterations <= 0:
+            raise CommandError('Only positive iterations are allowed ({}).'.format(iterations))
+        nbytes = options['bytes']
+        if nbytes <= 0:
+            raise CommandError('Only positive bytes are allowed ({}).'.format(nbytes))
+        pool_size = options['pool_size']
+        if pool_size <= 0:
+            raise CommandError('Only positive pool sizes are allowed ({}).'.format(pool_size))
+
+        pool = utils.TokenPool(nbytes, pool_size)
+        pool.get()
+
+        generators = (
+            ('legacy_long_token', utils.legacy_long_token),
+            ('secure_token', lambda: utils.secure_token(nbytes)),
+            ('TokenPool.get', pool.get),
+        )
+
+        for name, generator in generators:
+            seconds = timeit.timeit(generator, number=iterations)
+            self.stdout.write('{:<20} {:>10.2f} us/token {:>12.0f} tokens/s'.format(
+                name, seconds * 1e6 / iterations, iterations / seconds))
@@ -0,0 +1,59 @@
+"""
+Command to create (or drop) partial indexes covering live tokens only.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from provider.oauth2.models import RefreshToken
+
+# Name, model, indexed field and the boolean field that is false on live rows.
+PARTIAL_INDEXES = (
+    ('oauth2_refreshtoken_live_token', RefreshToken, 'token', 'expired'),
+)
+
+
+class Command(BaseCommand):
+    """
+    Example usage: ./manage.py create_partial_indexes
+
+    Most token rows are expired but not yet purged. A partial index restricted
+    to live rows stays small enough to remain in memory. Supported on
+    PostgreSQL, where indexes are built concurrently, and SQLite.
+    """
+    help = 'Creates partial indexes over live tokens on PostgreSQL and SQLite.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--drop',
+            action='store_true',
+            default=False,
+            help='Drop the partial indexes instead.'
+        )
+        parser.add_argument(
+            '--database',
+            default=DEFAULT_DB_ALIAS,
+            help='Database to create the indexes in.'
+        )
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            raise CommandError('Partial indexes are not supported on {}.'.format(connection.vendor))
+
+        quote_name = connection.ops.quote_name
+        concurrently = ' CONCURRENTLY' if connection.vendor == 'postgresql' else ''
+
+        with connection.cursor() as cursor:
+            for name, model, field_name, flag_name in PARTIAL_INDEXES:
+                if options['drop']:
+                    cursor.execute('DROP INDEX{} IF EXISTS {}'.format(concurrently, quote_name(name)))
+                    self.stdout.write('Dropped {}'.format(name))
+                    continue
+
+                flag = quote_name(model._meta.get_field(flag_name).column)
+                condition = 'NOT {}'.format(flag) if connection.vendor == 'postgresql' else '{} = 0'.format(flag)
+                cursor.execute('CREATE INDEX{} IF NOT EXISTS {} ON {} ({}) WHERE {}'.format(
+                    concurrently, quote_name(name), quote_name(model._meta.db_table),
+                    quote_name(model._meta.get_field(field_name).column), condition))
+                self.stdout.write('Created {}'.format(name))
@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from provider.oauth2.models import AccessToken, Grant, Client, RefreshToken
+from provider.oauth2.models import AccessToken, Grant, Client, Consent, RefreshToken
 
 
 @admin.register(AccessToken)
@@ -21,4 +21,10 @@ class ClientAdmin(admin.ModelAdmin):
     raw_id_fields = ('user',)
 
 
+@admin.register(Consent)
+class ConsentAdmin(admin.ModelAdmin):
+    list_display = ('user', 'client', 'scope',)
+    raw_id_fields = ('user',)
+
+
 admin.site.register(RefreshToken)
@@ -1,8 +1,34 @@
 import base64
+import binascii
 
+from django.utils.crypto import constant_time_compare
+
+from provider import constants
 from provider.oauth2.forms import ClientAuthForm, PublicPasswordGrantForm
-from provider.oauth2.models import AccessToken
-from provider.utils import now
+from provider.oauth2.models import AccessToken, Client
+from provider.tokens import verify_signed_token
+
+
+def get_basic_auth_credentials(request):
+    """
+    Return the ``(client_id, client_secret)`` pair from the HTTP authorization
+    header as defined in :rfc:`2.3.1`, or ``None`` if the header is missing or
+    malformed.
+    """
+    auth = request.META.get('HTTP_AUTHORIZATION')
+
+    if auth is None or auth == '':
+        return None
+
+    try:
+        basic, encoded = auth.split(' ')
+        decoded = base64.b64decode(encoded).decode()
+        client_id, client_secret = decoded.split(':')
+    except (ValueError, TypeError, binascii.Error):
+        # Auth header was malformed, unpacking went wrong
+        return None
+
+    return client_id, client_secret
 
 
 class BaseBackend(object):
@@ -26,27 +52,20 @@ class BasicClientBackend(object):
     """
 
     def authenticate(self, request=None):
-        auth = request.META.get('HTTP_AUTHORIZATION')
+        credentials = get_basic_auth_credentials(request)
 
-        if auth is None or auth == '':
+        if credentials is None:
             return None
 
-        try:
-            basic, encoded = auth.split(' ')
-            decoded = base64.b64decode(encoded).decode()
-            client_id, client_secret = decoded.split(':')
+        client_id, client_secret = credentials
 
-            form = ClientAuthForm({
-                'client_id': client_id,
-                'client_secret': client_secret})
+        form = ClientAuthForm({
+            'client_id': client_id,
+            'client_secret': client_secret})
 
-            if form.is_valid():
-                return form.cleaned_data.get('client')
-            return None
-
-        except ValueError:
-            # Auth header was malformed, unpacking went wrong
-            return None
+        if form.is_valid():
+            return form.cleaned_data.get('client')
+        return None
 
 
 class RequestParamsClientBackend(object):
@@ -94,6 +113,72 @@ class PublicPasswordBackend(object):
         return None
 
 
+class DispatchingClientBackend(object):
+    """
+    Backend that authenticates a client in a single pass over the request.
+    It decides which credential style is present and runs exactly one client
+    lookup, without building any forms:
+
+     - HTTP basic authorization as in :class:`BasicClientBackend`
+     - client ID and secret in the POST body as in
+       :class:`RequestParamsClientBackend`
+     - a client ID alone for ``grant_type=password`` requests by public
+       clients as in :class:`PublicPasswordBackend`
+
+    Unlike :class:`PublicPasswordBackend`, the user's password is not checked
+    here; the password grant handler checks it once.
+    """
+
+    def get_credentials(self, request):
+        """
+        Return a ``(client_id, client_secret)`` pair. ``client_secret`` is
+        ``None`` for public clients. Return ``None`` if no credentials are
+        present.
+        """
+        credentials = get_basic_auth_credentials(request)
+        if credentials is not None:
+            return credentials
+
+        if request.method != 'POST':
+            return None
+
+        client_id = request.POST.get('client_id')
+        if not client_id:
+            return None
+
+        client_secret = request.POST.get('client_secret')
+        if client_secret:
+            return client_id, client_secret
+
+        if request.POST.get('grant_type') == 'password':
+            return client_id, None
+
+        return None
+
+    def authenticate(self, request=None):
+        if request is None:
+            return None
+
+        credentials = self.get_credentials(request)
+        if credentials is None:
+            return None
+
+        client_id, client_secret = credentials
+
+        try:
+            client = Client.objects.get_by_client_id(client_id)
+        except Client.DoesNotExist:
+            return None
+
+        if client_secret is None:
+            if client.client_type != constants.PUBLIC:
+                return None
+        elif not constant_time_compare(client.client_secret, client_secret):
+            return None
+
+        return client
+
+
 class AccessTokenBackend(object):
     """
     Authenticate a user via access token and client object.
@@ -101,8 +186,35 @@ class AccessTokenBackend(object):
 
     def authenticate(self, access_token=None, client=None):
         try:
-            return AccessToken.objects.get(token=access_token,
-                                           expires__gt=now(),
-                                           client=client)
+            token = AccessToken.objects.get_token(access_token)
         except AccessToken.DoesNotExist:
             return None
+
+        if client is None or token.client_id != client.pk:
+            return None
+
+        return token
+
+
+class SignedAccessTokenBackend(object):
+    """
+    Authenticate a user via a signed access token (see
+    :attr:`provider.constants.SIGNED_TOKENS`) and client object without any
+    database access. Returns an unsaved access token built from the token's
+    claims.
+
+    .. note:: Revoked tokens keep validating until they expire. Use
+        :class:`AccessTokenBackend` where revocation must apply at once.
+    """
+
+    def authenticate(self, access_token=None, client=None):
+        claims = verify_signed_token(access_token)
+
+        if claims is None or client is None or claims.client_id != client.pk:
+            return None
+
+        return AccessToken(token=access_token,
+                           user_id=claims.user_id,
+                           client=client,
+                           scope=claims.scope,
+                           expires=claims.expires)
@@ -0,0 +1,500 @@
+"""
+Cache layers used to keep hot lookups, such as bearer token validation, away
+from the database. All caches go through the Django cache configured by
+:attr:`provider.constants.CACHE_ALIAS`.
+"""
+
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.encoding import force_bytes
+from six.moves import cPickle as pickle
+
+from provider import constants
+from provider.utils import now
+
+
+def get_cache():
+    """
+    Return the Django cache used by the provider.
+    """
+    return caches[constants.CACHE_ALIAS]
+
+
+def make_key(prefix, value):
+    """
+    Return a cache key for ``value``. Values are hashed so that secrets such as
+    tokens never show up in cache keys and keys stay within memcached limits.
+    """
+    return 'oauth2:%s:%s' % (prefix, hashlib.sha256(force_bytes(value)).hexdigest())
+
+
+def evict(delete, using=None):
+    """
+    Call ``delete`` to evict a changed row from a cache, and inside a
+    transaction once more after it commits: until then, concurrent requests
+    still read the old row from the database and may cache it again.
+    """
+    delete()
+    if transaction.get_connection(using).in_atomic_block:
+        transaction.on_commit(delete, using=using)
+
+
+class LocalCache(object):
+    """
+    Bounded, thread-safe, in-process LRU cache with per-entry timeouts.
+
+    Values are stored pickled so that callers never share (and mutate) the
+    cached instance. Hits and misses are counted in :attr:`hits` and
+    :attr:`misses`.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used.
+            self._data[key] = entry
+            self.hits += 1
+        return pickle.loads(entry[1])
+
+    def set(self, key, value, timeout):
+        if not self.enabled or timeout <= 0:
+            return
+        entry = (time.time() + timeout, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = entry
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+MISSING = object()
+"""
+Returned by :meth:`AccessTokenCache.get` for tokens recently found not to
+exist.
+"""
+
+
+class AccessTokenCache(object):
+    """
+    Read-through cache for :class:`provider.oauth2.models.AccessToken`
+    instances keyed by their token string.
+
+    Lookups go through two tiers: a small :class:`LocalCache` in the current
+    process (see :attr:`provider.constants.ACCESS_TOKEN_LOCAL_CACHE_SIZE`) and
+    the shared Django cache (see
+    :attr:`provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT`). Either tier can be
+    disabled on its own. Entries never outlive the token itself.
+
+    Evictions only reach the local tier of the current process, so other
+    processes may serve a revoked token for up to
+    :attr:`provider.constants.ACCESS_TOKEN_LOCAL_CACHE_TIMEOUT` seconds.
+
+    Tokens that were looked up and not found are remembered in the shared
+    cache for :attr:`provider.constants.ACCESS_TOKEN_NEGATIVE_CACHE_TIMEOUT`
+    seconds, so repeated garbage or long expired tokens do not reach the
+    database.
+    """
+    prefix = 'access_token'
+    negative_prefix = 'access_token_miss'
+
+    def __init__(self):
+        self.local = LocalCache(constants.ACCESS_TOKEN_LOCAL_CACHE_SIZE)
+
+    @property
+    def enabled(self):
+        return bool(constants.ACCESS_TOKEN_CACHE_TIMEOUT)
+
+    @property
+    def negative_enabled(self):
+        return bool(constants.ACCESS_TOKEN_NEGATIVE_CACHE_TIMEOUT)
+
+    def get(self, token):
+        """
+        Return the cached access token, :attr:`MISSING` if the token is known
+        not to exist or ``None`` if the cache does not know about it.
+        """
+        key = make_key(self.prefix, token)
+
+        if self.local.enabled:
+            access_token = self.local.get(key)
+            if access_token is not None:
+                return access_token
+
+        keys = self._shared_keys(token)
+        if not keys:
+            return None
+
+        # A single round-trip answers both the positive and negative lookup.
+        values = get_cache().get_many(keys)
+
+        access_token = values.get(key)
+        if access_token is not None:
+            self._set_local(key, access_token)
+            return access_token
+
+        if values.get(make_key(self.negative_prefix, token)):
+            return MISSING
+
+        return None
+
+    def get_many(self, tokens):
+        """
+        Return a dict mapping each token the cache knows about to its access
+        token or :attr:`MISSING`. Tokens the cache knows nothing about are left
+        out. The shared tier is read in a single round-trip.
+        """
+        results = {}
+        shared_keys = {}
+
+        for token in tokens:
+            key = make_key(self.prefix, token)
+            access_token = self.local.get(key) if self.local.enabled else None
+            if access_token is not None:
+                results[token] = access_token
+            else:
+                for shared_key in self._shared_keys(token):
+                    shared_keys[shared_key] = token
+
+        if shared_keys:
+            values = get_cache().get_many(list(shared_keys))
+            for shared_key, value in values.items():
+                token = shared_keys[shared_key]
+                if shared_key == make_key(self.prefix, token):
+                    results[token] = value
+                    self._set_local(shared_key, value)
+                elif value:
+                    results.setdefault(token, MISSING)
+
+        return results
+
+    def set(self, access_token):
+        key = make_key(self.prefix, access_token.token)
+        self._set_local(key, access_token)
+
+        if not self.enabled:
+            return
+        timeout = min(constants.ACCESS_TOKEN_CACHE_TIMEOUT, access_token.get_expire_delta())
+        if timeout > 0:
+            get_cache().set(key, access_token, timeout)
+
+    def set_missing(self, token):
+        """
+        Remember that ``token`` does not match any valid access token.
+        """
+        if not self.negative_enabled:
+            return
+        get_cache().set(make_key(self.negative_prefix, token), True,
+                        constants.ACCESS_TOKEN_NEGATIVE_CACHE_TIMEOUT)
+
+    def delete(self, token):
+        """
+        Forget everything known about ``token``, including a negative entry.
+        """
+        self.local.delete(make_key(self.prefix, token))
+
+        keys = self._shared_keys(token)
+        if keys:
+            get_cache().delete_many(keys)
+
+    def _shared_keys(self, token):
+        keys = []
+        if self.enabled:
+            keys.append(make_key(self.prefix, token))
+        if self.negative_enabled:
+            keys.append(make_key(self.negative_prefix, token))
+        return keys
+
+    def _set_local(self, key, access_token):
+        if self.local.enabled:
+            timeout = min(constants.ACCESS_TOKEN_LOCAL_CACHE_TIMEOUT, access_token.get_expire_delta())
+            self.local.set(key, access_token, timeout)
+
+
+access_token_cache = AccessTokenCache()
+
+
+class SingleAccessTokenCache(object):
+    """
+    Cache pointing a ``(user, client, scope)`` combination at its current
+    reusable access token, see :attr:`provider.constants.SINGLE_ACCESS_TOKEN`.
+    Only the token string is stored; callers resolve it through
+    :class:`AccessTokenCache` and must check that it is still valid. Enabled
+    by :attr:`provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT`.
+    """
+    prefix = 'single_access_token'
+
+    @property
+    def enabled(self):
+        return bool(constants.ACCESS_TOKEN_CACHE_TIMEOUT)
+
+    def _key(self, user_id, client_id, scope):
+        return make_key(self.prefix, '%s:%s:%s' % (user_id, client_id, scope))
+
+    def get(self, user_id, client_id, scope):
+        if not self.enabled:
+            return None
+        return get_cache().get(self._key(user_id, client_id, scope))
+
+    def set(self, access_token):
+        if not self.enabled:
+            return
+        timeout = min(constants.ACCESS_TOKEN_CACHE_TIMEOUT, access_token.get_expire_delta())
+        if timeout > 0:
+            key = self._key(access_token.user_id, access_token.client_id, access_token.scope)
+            get_cache().set(key, access_token.token, timeout)
+
+    def delete(self, user_id, client_id, scope):
+        if not self.enabled:
+            return
+        get_cache().delete(self._key(user_id, client_id, scope))
+
+
+single_access_token_cache = SingleAccessTokenCache()
+
+
+class ClientCredentialsTokenCache(object):
+    """
+    Cache of the access token issued to a client through the client
+    credentials grant, keyed by client and scope, for clients with
+    :attr:`provider.oauth2.models.Client.reuse_client_credentials_token` set.
+    Enabled by :attr:`provider.constants.CLIENT_CREDENTIALS_TOKEN_REUSE`.
+
+    Tokens are kept in a :class:`LocalCache` (see
+    :attr:`provider.constants.ACCESS_TOKEN_LOCAL_CACHE_SIZE`) and the shared
+    cache until only
+    :attr:`provider.constants.CLIENT_CREDENTIALS_TOKEN_REUSE_THRESHOLD` of
+    their lifetime remains.
+    """
+    prefix = 'client_credentials_token'
+
+    def __init__(self):
+        self.local = LocalCache(constants.ACCESS_TOKEN_LOCAL_CACHE_SIZE)
+
+    @property
+    def enabled(self):
+        return bool(constants.CLIENT_CREDENTIALS_TOKEN_REUSE)
+
+    def _key(self, client_id, scope):
+        return make_key(self.prefix, '%s:%s' % (client_id, scope))
+
+    def get(self, client_id, scope):
+        key = self._key(client_id, scope)
+
+        access_token = self.local.get(key) if self.local.enabled else None
+        if access_token is None:
+            access_token = get_cache().get(key)
+            if access_token is not None and self.local.enabled:
+                self.local.set(key, access_token, min(constants.ACCESS_TOKEN_LOCAL_CACHE_TIMEOUT,
+                                                      self._get_timeout(access_token)))
+        return access_token
+
+    def set(self, access_token):
+        timeout = self._get_timeout(access_token)
+        if timeout <= 0:
+            return
+
+        key = self._key(access_token.client_id, access_token.scope)
+        if self.local.enabled:
+            self.local.set(key, access_token, min(constants.ACCESS_TOKEN_LOCAL_CACHE_TIMEOUT, timeout))
+        get_cache().set(key, access_token, timeout)
+
+    def delete(self, client_id, scope):
+        key = self._key(client_id, scope)
+        self.local.delete(key)
+        get_cache().delete(key)
+
+    def _get_timeout(self, access_token):
+        """
+        Return the number of seconds until ``access_token`` reaches the reuse
+        threshold.
+        """
+        lifetime = (access_token.client.get_default_token_expiry() - now()).total_seconds()
+        return int(access_token.get_expire_delta() - constants.CLIENT_CREDENTIALS_TOKEN_REUSE_THRESHOLD * lifetime)
+
+
+client_credentials_token_cache = ClientCredentialsTokenCache()
+
+
+class ClientCache(object):
+    """
+    Cache for :class:`provider.oauth2.models.Client` instances keyed by their
+    ``client_id``, enabled by :attr:`provider.constants.CLIENT_CACHE_TIMEOUT`.
+
+    Entries are tagged with a registry version that is replaced whenever any
+    client is saved or deleted, which invalidates every entry at once, even
+    for changed ``client_id`` values. The version and the entry are read in a
+    single round-trip.
+    """
+    prefix = 'client'
+    version_key = 'oauth2:client_version'
+
+    @property
+    def enabled(self):
+        return bool(constants.CLIENT_CACHE_TIMEOUT)
+
+    def get(self, client_id):
+        """
+        Return a ``(client, version)`` tuple. ``client`` is ``None`` on a miss,
+        in which case ``version`` should be passed back to :meth:`set`.
+        """
+        if not self.enabled:
+            return None, None
+
+        key = make_key(self.prefix, client_id)
+        values = get_cache().get_many([self.version_key, key])
+        version = values.get(self.version_key)
+        entry = values.get(key)
+
+        if version is None or entry is None or entry[0] != version:
+            return None, version
+        return entry[1], version
+
+    def set(self, client, version):
+        """
+        Cache ``client`` for the registry ``version`` read before the client
+        was fetched, so that a concurrent invalidation is never overwritten.
+        """
+        if not self.enabled:
+            return
+
+        cache = get_cache()
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+
+        cache.set(make_key(self.prefix, client.client_id), (version, client), constants.CLIENT_CACHE_TIMEOUT)
+
+    def invalidate(self):
+        """
+        Invalidate every cached client.
+        """
+        if not self.enabled:
+            return
+        get_cache().set(self.version_key, uuid.uuid4().hex, None)
+
+
+client_cache = ClientCache()
+
+
+class IdempotencyCache(object):
+    """
+    Cache of token endpoint responses keyed by client and ``Idempotency-Key``
+    header, enabled by :attr:`provider.constants.IDEMPOTENCY_KEY_TIMEOUT`.
+    Each entry carries a fingerprint of the request it answers, so a key
+    cannot be replayed for a different request.
+
+    A request claims its key with :meth:`reserve` before it is handled, so a
+    concurrent retry finds a pending entry instead of issuing tokens too.
+    Pending entries expire after ``pending_timeout`` seconds at the latest,
+    in case the request that claimed the key never finishes.
+    """
+    prefix = 'idempotency'
+    pending_timeout = 60
+
+    @property
+    def enabled(self):
+        return bool(constants.IDEMPOTENCY_KEY_TIMEOUT)
+
+    def _key(self, client_id, idempotency_key):
+        return make_key(self.prefix, '%s:%s' % (client_id, idempotency_key))
+
+    def get(self, client_id, idempotency_key):
+        """
+        Return a ``(fingerprint, status, content_type, content)`` tuple or
+        ``None``. ``status`` is ``None`` while the request is pending.
+        """
+        if not self.enabled:
+            return None
+        return get_cache().get(self._key(client_id, idempotency_key))
+
+    def reserve(self, client_id, idempotency_key, fingerprint):
+        """
+        Atomically claim the key for a pending request. Return ``False`` if
+        the key is taken.
+        """
+        if not self.enabled:
+            return True
+        timeout = min(self.pending_timeout, constants.IDEMPOTENCY_KEY_TIMEOUT)
+        return get_cache().add(self._key(client_id, idempotency_key), (fingerprint, None, None, None), timeout)
+
+    def set(self, client_id, idempotency_key, fingerprint, response):
+        if not self.enabled:
+            return
+        entry = (fingerprint, response.status_code, response['Content-Type'], response.content)
+        get_cache().set(self._key(client_id, idempotency_key), entry, constants.IDEMPOTENCY_KEY_TIMEOUT)
+
+    def delete(self, client_id, idempotency_key):
+        if not self.enabled:
+            return
+        get_cache().delete(self._key(client_id, idempotency_key))
+
+
+idempotency_cache = IdempotencyCache()
+
+
+class ConsentCache(object):
+    """
+    Cache of the scope a user consented to for a client, see
+    :attr:`provider.constants.REMEMBER_CONSENT`, enabled by
+    :attr:`provider.constants.CONSENT_CACHE_TIMEOUT`. ``0`` is cached for
+    users without consent.
+    """
+    prefix = 'consent'
+
+    @property
+    def enabled(self):
+        return bool(constants.CONSENT_CACHE_TIMEOUT)
+
+    def _key(self, user_id, client_id):
+        return make_key(self.prefix, '%s:%s' % (user_id, client_id))
+
+    def get(self, user_id, client_id):
+        if not self.enabled:
+            return None
+        return get_cache().get(self._key(user_id, client_id))
+
+    def set(self, user_id, client_id, scope):
+        if not self.enabled:
+            return
+        get_cache().set(self._key(user_id, client_id), scope, constants.CONSENT_CACHE_TIMEOUT)
+
+    def delete(self, user_id, client_id):
+        if not self.enabled:
+            return
+        get_cache().delete(self._key(user_id, client_id))
+
+
+consent_cache = ConsentCache()
@@ -1,14 +1,17 @@
 from django import forms
 from django.contrib.auth import authenticate
+from django.db import connections
+from django.utils.crypto import constant_time_compare
 from django.utils.encoding import smart_text
 from django.utils.translation import ugettext as _
 
-from provider import scope
+from provider import constants, scope
 from provider.constants import RESPONSE_TYPE_CHOICES, SCOPES
 from provider.forms import OAuthForm, OAuthValidationError
 from provider.oauth2.models import Client, Grant, RefreshToken
+from provider.oauth2.stores import get_grant_store
 from provider.scope import SCOPE_NAMES
-from provider.utils import now
+from provider.tokens import check_token
 
 
 class ClientForm(forms.ModelForm):
@@ -37,9 +40,11 @@ class ClientAuthForm(forms.Form):
     def clean(self):
         data = self.cleaned_data
         try:
-            client = Client.objects.get(client_id=data.get('client_id'),
-                                        client_secret=data.get('client_secret'))
+            client = Client.objects.get_by_client_id(data.get('client_id'))
         except Client.DoesNotExist:
+            client = None
+
+        if client is None or not constant_time_compare(client.client_secret, data.get('client_secret') or ''):
             raise forms.ValidationError(_("Client could not be validated with "
                                           "key pair."))
 
@@ -212,12 +217,34 @@ class RefreshTokenGrantForm(ScopeMixin, OAuthForm):
         if not token:
             raise OAuthValidationError({'error': 'invalid_request'})
 
+        if not check_token(token):
+            raise OAuthValidationError({'error': 'invalid_grant'})
+
+        # Lock the token so concurrent refreshes are serialized. Expired tokens
+        # are only needed when a replay may fall into the grace period;
+        # otherwise the lookup can use a partial index over live tokens.
+        # Only the token row is locked: where the database cannot restrict
+        # the lock to it, the row is locked on its own and then read with its
+        # relations. The successor of an exchanged token is loaded on demand.
+        lookup = {'token': token, 'client': self.client}
+        if not constants.REFRESH_TOKEN_GRACE_PERIOD:
+            lookup['expired'] = False
+        features = connections[RefreshToken.objects.db].features
+        queryset = RefreshToken.objects.select_related('access_token__client', 'user')
         try:
-            token = RefreshToken.objects.get(token=token,
-                                             expired=False, client=self.client)
+            if getattr(features, 'has_select_for_update_of', False):
+                token = queryset.select_for_update(of=('self',)).get(**lookup)
+            elif features.has_select_for_update:  # Django < 2.0, or no support in the database
+                locked = RefreshToken.objects.select_for_update().filter(**lookup)
+                token = queryset.get(pk=locked.values_list('pk', flat=True).get())
+            else:
+                token = queryset.get(**lookup)
         except RefreshToken.DoesNotExist:
             raise OAuthValidationError({'error': 'invalid_grant'})
 
+        if token.expired and not token.in_grace_period():
+            raise OAuthValidationError({'error': 'invalid_grant'})
+
         return token
 
     def clean(self):
@@ -254,8 +281,7 @@ class AuthorizationCodeGrantForm(ScopeMixin, OAuthForm):
             raise OAuthValidationError({'error': 'invalid_request'})
 
         try:
-            self.cleaned_data['grant'] = Grant.objects.get(
-                code=code, client=self.client, expires__gt=now())
+            self.cleaned_data['grant'] = get_grant_store().get(code, self.client)
         except Grant.DoesNotExist:
             raise OAuthValidationError({'error': 'invalid_grant'})
 
@@ -332,7 +358,7 @@ class PublicPasswordGrantForm(PasswordGrantForm):
         data = super(PublicPasswordGrantForm, self).clean()
 
         try:
-            client = Client.objects.get(client_id=data.get('client_id'))
+            client = Client.objects.get_by_client_id(data.get('client_id'))
         except Client.DoesNotExist:
             raise OAuthValidationError({'error': 'invalid_client'})
 
@@ -1,7 +1,207 @@
+from datetime import timedelta
+from functools import partial
+
+from provider import scope as scopes
+from provider.oauth2.cache import MISSING, access_token_cache, client_cache, client_credentials_token_cache, \
+    consent_cache, evict, single_access_token_cache
+from provider.tokens import check_token
 from provider.utils import now
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+
+
+class ClientManager(models.Manager):
+    def get_by_client_id(self, client_id):
+        """
+        Return the client identified by ``client_id``, going through
+        :attr:`provider.oauth2.cache.client_cache` first. The password hash of
+        the client's user is deferred, so that it is not cached.
+        """
+        client, version = client_cache.get(client_id)
+
+        if client is None:
+            client = self.select_related('user').defer('user__password').get(client_id=client_id)
+            client_cache.set(client, version)
+
+        return client
+
+
+class ConsentManager(models.Manager):
+    def get_scope(self, user, client):
+        """
+        Return the scope ``user`` consented to for ``client``, or ``0``, going
+        through :attr:`provider.oauth2.cache.consent_cache` first.
+        """
+        scope = consent_cache.get(user.pk, client.pk)
+
+        if scope is None:
+            scope = self.filter(user=user, client=client).values_list('scope', flat=True).first() or 0
+            consent_cache.set(user.pk, client.pk, scope)
+
+        return scope
+
+    def grant(self, user, client, scope):
+        """
+        Remember that ``user`` consented to ``scope`` for ``client``, in
+        addition to any scope consented to before.
+        """
+        consent, created = self.get_or_create(user=user, client=client, defaults={'scope': scope})
+        if not created and not scopes.check(scope, consent.scope):
+            consent.scope |= scope
+            consent.save(update_fields=['scope'])
+        return consent
 
 
 class AccessTokenManager(models.Manager):
+    def _with_user(self):
+        """
+        Return a queryset loading the user of the tokens, except for the
+        password hash, so that it does not end up in the shared cache.
+        """
+        return self.select_related('user').defer('user__password')
+
     def get_token(self, token):
-        return self.get(token=token, expires__gt=now())
+        """
+        Return the unexpired access token matching ``token``, going through
+        :attr:`provider.oauth2.cache.access_token_cache` first.
+        """
+        if not check_token(token):
+            raise self.model.DoesNotExist
+
+        access_token = access_token_cache.get(token)
+
+        if access_token is MISSING:
+            raise self.model.DoesNotExist
+
+        if access_token is None:
+            try:
+                access_token = self._with_user().get(token=token, expires__gt=now())
+            except self.model.DoesNotExist:
+                access_token_cache.set_missing(token)
+                raise
+            access_token_cache.set(access_token)
+        elif access_token.get_expire_delta() <= 0:
+            raise self.model.DoesNotExist
+
+        return access_token
+
+    def get_tokens(self, tokens):
+        """
+        Return a dict mapping each of the given ``tokens`` that is valid and
+        unexpired to its access token. Tokens not found in
+        :attr:`provider.oauth2.cache.access_token_cache` are resolved with a
+        single query.
+        """
+        tokens = set(token for token in tokens if check_token(token))
+
+        results = {}
+        for token, access_token in access_token_cache.get_many(tokens).items():
+            tokens.discard(token)
+            if access_token is not MISSING and access_token.get_expire_delta() > 0:
+                results[token] = access_token
+
+        if tokens:
+            for access_token in self._with_user().filter(token__in=tokens, expires__gt=now()):
+                results[access_token.token] = access_token
+                access_token_cache.set(access_token)
+
+            for token in tokens.difference(results):
+                access_token_cache.set_missing(token)
+
+        return results
+
+    def get_reusable_token(self, user, client, scope):
+        """
+        Return the unexpired access token for the given user, client and scope
+        combination, see :attr:`provider.constants.SINGLE_ACCESS_TOKEN`. The
+        current token is remembered in
+        :attr:`provider.oauth2.cache.single_access_token_cache`.
+        """
+        token = single_access_token_cache.get(user.pk, client.pk, scope)
+
+        if token is not None:
+            try:
+                access_token = self.get_token(token)
+            except self.model.DoesNotExist:
+                single_access_token_cache.delete(user.pk, client.pk, scope)
+            else:
+                if (access_token.user_id, access_token.client_id, access_token.scope) == (user.pk, client.pk, scope):
+                    return access_token
+
+        access_token = self._with_user().get(user=user, client=client, scope=scope, expires__gt=now())
+        access_token_cache.set(access_token)
+        single_access_token_cache.set(access_token)
+        return access_token
+
+    def expire_surplus_tokens(self, user, client, keep):
+        """
+        Expire all but the ``keep`` newest unexpired access tokens of the given
+        user and client with a single ``UPDATE``, see
+        :attr:`provider.constants.MAX_ACTIVE_ACCESS_TOKENS`. Their refresh
+        tokens stay valid.
+        """
+        surplus = self.filter(user=user, client=client, expires__gt=now()).order_by('-pk').values('pk')[keep:]
+
+        features = connections[self.db].features
+        if not getattr(features, 'allow_sliced_subqueries_with_in', getattr(features, 'allow_sliced_subqueries', True)):
+            # MySQL cannot limit a subquery.
+            surplus = [row['pk'] for row in surplus]
+
+        expires = now() - timedelta(milliseconds=1)
+        expired = self.filter(pk__in=surplus).update(expires=expires, reuse_key=None)
+
+        # Bulk updates send no signals, so evict the cached tokens here. Only
+        # needed, and only costs a query, when the tokens may be cached.
+        reused = client_credentials_token_cache.enabled and client.reuse_client_credentials_token
+        if expired and (access_token_cache.enabled or reused):
+            touched = self.filter(user=user, client=client, expires=expires).values_list('token', 'scope')
+            for token, scope in touched:
+                evict(partial(access_token_cache.delete, token), self.db)
+                if reused:
+                    evict(partial(client_credentials_token_cache.delete, client.pk, scope), self.db)
+
+        return expired
+
+    def get_or_create_reusable_token(self, user, client, scope, defaults):
+        """
+        Return an ``(access_token, created)`` tuple with the unexpired access
+        token for the given user, client and scope combination, creating it
+        from ``defaults`` if there is none.
+
+        Reusable tokens hold a unique ``reuse_key``, so concurrent callers end
+        up with the same token: the token is inserted in a savepoint and on an
+        ``IntegrityError`` the existing token is locked with
+        ``select_for_update``. An expired token holding the key gives it up.
+        """
+        reuse_key = self.model.get_reuse_key(user.pk, client.pk, scope)
+
+        with transaction.atomic(using=self.db):
+            # A second attempt only happens after the key was released by an
+            # expired or deleted token.
+            for attempt in range(2):
+                access_token = self.model(user=user, client=client, scope=scope, reuse_key=reuse_key, **defaults)
+                if self._insert_reusable_token(access_token):
+                    return access_token, True
+
+                try:
+                    existing = self._with_user().select_for_update().get(reuse_key=reuse_key)
+                except self.model.DoesNotExist:
+                    continue
+
+                if existing.get_expire_delta() > 0:
+                    return existing, False
+
+                self.filter(pk=existing.pk).update(reuse_key=None)
+
+        raise IntegrityError('Could not claim reuse key %s' % reuse_key)
+
+    def _insert_reusable_token(self, access_token):
+        """
+        Insert ``access_token`` unless another token holds its ``reuse_key``.
+        Return ``True`` if it was inserted.
+        """
+        try:
+            with transaction.atomic(using=self.db):
+                access_token.save(force_insert=True, using=self.db)
+        except IntegrityError:
+            return False
+        return True
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('oauth2', '0005_grant_nonce'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='accesstoken',
+            index_together=set([('user', 'client', 'scope', 'expires')]),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0006_add_index_on_accesstoken_reuse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='reuse_key',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0007_accesstoken_reuse_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='refreshtoken',
+            name='expired_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='refreshtoken',
+            name='successor',
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+',
+                to='oauth2.RefreshToken'),
+        ),
+    ]
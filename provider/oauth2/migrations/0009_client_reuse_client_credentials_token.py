@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('oauth2', '0008_refreshtoken_rotation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='reuse_client_credentials_token',
+            field=models.BooleanField(
+                default=False, help_text='Reuse a still valid access token for the client credentials grant.'),
+        ),
+    ]
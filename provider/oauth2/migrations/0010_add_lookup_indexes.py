@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+import provider.oauth2.operations
+import provider.utils
+
+
+class Migration(migrations.Migration):
+
+    # Indexes are built concurrently on PostgreSQL, which cannot happen in a
+    # transaction.
+    atomic = False
+
+    dependencies = [
+        ('oauth2', '0009_client_reuse_client_credentials_token'),
+    ]
+
+    operations = [
+        provider.oauth2.operations.AddFieldIndexConcurrently(
+            model_name='client',
+            name='client_id',
+            field=models.CharField(default=provider.utils.short_token, max_length=255, unique=True),
+        ),
+        provider.oauth2.operations.AddFieldIndexConcurrently(
+            model_name='grant',
+            name='code',
+            field=models.CharField(db_index=True, default=provider.utils.long_token, max_length=255),
+        ),
+        provider.oauth2.operations.AddFieldIndexConcurrently(
+            model_name='refreshtoken',
+            name='token',
+            field=models.CharField(db_index=True, default=provider.utils.long_token, max_length=255),
+        ),
+    ]
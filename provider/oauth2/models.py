@@ -4,14 +4,21 @@ implement these models with fields and and methods to be compatible with the
 views in :attr:`provider.views`.
 """
 
+from datetime import timedelta
+from functools import partial
+
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 
 from provider import constants
 from provider.constants import CLIENT_TYPES
-from provider.oauth2.managers import AccessTokenManager
+from provider.oauth2.cache import access_token_cache, client_cache, client_credentials_token_cache, consent_cache, \
+    evict
+from provider.oauth2.managers import AccessTokenManager, ClientManager, ConsentManager
 from provider.utils import get_token_expiry, serialize_instance, deserialize_instance
 from provider.utils import now, short_token, long_token, get_code_expiry
 
@@ -47,10 +54,14 @@ class Client(models.Model):
     name = models.CharField(max_length=255, blank=True)
     url = models.URLField(help_text="Your application's URL.")
     redirect_uri = models.URLField(help_text="Your application's callback URL")
-    client_id = models.CharField(max_length=255, default=short_token)
+    client_id = models.CharField(max_length=255, default=short_token, unique=True)
     client_secret = models.CharField(max_length=255, default=long_token)
     client_type = models.IntegerField(choices=CLIENT_TYPES)
     logout_uri = models.URLField(help_text="Your application's logout URL", null=True, blank=True)
+    reuse_client_credentials_token = models.BooleanField(
+        default=False, help_text="Reuse a still valid access token for the client credentials grant.")
+
+    objects = ClientManager()
 
     def __str__(self):
         return self.redirect_uri
@@ -67,7 +78,8 @@ class Client(models.Model):
                     client_id=self.client_id,
                     client_secret=self.client_secret,
                     client_type=self.client_type,
-                    logout_uri=self.logout_uri)
+                    logout_uri=self.logout_uri,
+                    reuse_client_credentials_token=self.reuse_client_credentials_token)
 
     @classmethod
     def deserialize(cls, data):
@@ -114,7 +126,7 @@ class Grant(models.Model):
 
     user = models.ForeignKey(AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='dop_grant')
     client = models.ForeignKey(Client, on_delete=models.CASCADE)
-    code = models.CharField(max_length=255, default=long_token)
+    code = models.CharField(max_length=255, default=long_token, db_index=True)
     nonce = models.CharField(max_length=255, blank=True, default='')
     expires = models.DateTimeField(default=get_code_expiry)
     redirect_uri = models.CharField(max_length=255, blank=True)
@@ -148,6 +160,9 @@ class AccessToken(models.Model):
 
     class Meta:
         app_label = "oauth2"
+        # Covers the lookup of a reusable token, see
+        # :attr:`provider.constants.SINGLE_ACCESS_TOKEN`.
+        index_together = ["user", "client", "scope", "expires"]
 
     user = models.ForeignKey(AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='dop_access_token')
     token = models.CharField(max_length=255, default=long_token, db_index=True)
@@ -155,12 +170,19 @@ class AccessToken(models.Model):
     expires = models.DateTimeField()
     scope = models.IntegerField(default=constants.SCOPES[0][0],
                                 choices=constants.SCOPES)
+    # Set on the one reusable token of a user/client/scope combination, see
+    # :attr:`provider.constants.ATOMIC_SINGLE_ACCESS_TOKEN`.
+    reuse_key = models.CharField(max_length=255, null=True, blank=True, unique=True, editable=False)
 
     objects = AccessTokenManager()
 
     def __str__(self):
         return self.token
 
+    @staticmethod
+    def get_reuse_key(user_id, client_id, scope):
+        return '%s:%s:%s' % (user_id, client_id, scope)
+
     def save(self, *args, **kwargs):
         if not self.expires:
             self.expires = self.client.get_default_token_expiry()
@@ -205,11 +227,109 @@ class RefreshToken(models.Model):
         app_label = "oauth2"
 
     user = models.ForeignKey(AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='dop_refresh_token')
-    token = models.CharField(max_length=255, default=long_token)
+    token = models.CharField(max_length=255, default=long_token, db_index=True)
     access_token = models.OneToOneField(AccessToken, on_delete=models.CASCADE,
                                         related_name='refresh_token')
     client = models.ForeignKey(Client, on_delete=models.CASCADE)
     expired = models.BooleanField(default=False)
+    expired_at = models.DateTimeField(null=True, blank=True)
+    # The refresh token issued in exchange for this one, see
+    # :attr:`provider.constants.REFRESH_TOKEN_GRACE_PERIOD`.
+    successor = models.ForeignKey('self', null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
 
     def __str__(self):
         return self.token
+
+    def in_grace_period(self):
+        """
+        Return ``True`` if this token was exchanged less than
+        :attr:`provider.constants.REFRESH_TOKEN_GRACE_PERIOD` seconds ago and
+        the tokens issued in exchange are still valid, in which case a replay
+        returns those tokens.
+        """
+        if not (self.expired and self.expired_at and self.successor_id and constants.REFRESH_TOKEN_GRACE_PERIOD):
+            return False
+        if now() - self.expired_at > timedelta(seconds=constants.REFRESH_TOKEN_GRACE_PERIOD):
+            return False
+        return not self.successor.expired and self.successor.access_token.get_expire_delta() > 0
+
+
+@python_2_unicode_compatible
+class Consent(models.Model):
+    """
+    The scope a resource owner approved for a client, so that later
+    authorization requests for the same or a narrower scope skip the
+    authorization screen. See :attr:`provider.constants.REMEMBER_CONSENT`.
+
+    Expected fields:
+
+    * :attr:`user`
+    * :attr:`client` - :class:`Client`
+    * :attr:`scope`
+    """
+
+    class Meta:
+        app_label = "oauth2"
+        unique_together = ["user", "client"]
+
+    user = models.ForeignKey(AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='dop_consent')
+    client = models.ForeignKey(Client, on_delete=models.CASCADE)
+    scope = models.IntegerField(default=0)
+
+    objects = ConsentManager()
+
+    def __str__(self):
+        return '%s: %s' % (self.user, self.client)
+
+
+@receiver(post_save, sender=Client)
+@receiver(post_delete, sender=Client)
+def invalidate_clients(sender, instance, using=None, **kwargs):
+    """
+    Invalidate the client registry cache whenever a client changes.
+    """
+    evict(client_cache.invalidate, using)
+
+
+@receiver(post_save, sender=AccessToken)
+@receiver(post_delete, sender=AccessToken)
+def evict_access_token(sender, instance, using=None, **kwargs):
+    """
+    Drop cached copies of an access token whenever it is saved or deleted, so
+    that revoked tokens stop validating at once and newly created tokens are
+    no longer remembered as missing.
+    """
+    evict(partial(access_token_cache.delete, instance.token), using)
+
+
+@receiver(post_save, sender=AccessToken)
+@receiver(post_delete, sender=AccessToken)
+def evict_client_credentials_token(sender, instance, signal, created=False, using=None, **kwargs):
+    """
+    Stop reusing a client credentials token once any token of the same client
+    and scope changes or is deleted. Skipped while reuse is disabled, for
+    deleted tokens that had expired, which are no longer cached, and for
+    clients that do not reuse tokens, when the client is already loaded.
+    """
+    if created or not client_credentials_token_cache.enabled:
+        return
+
+    if signal is post_delete and instance.expires <= now():
+        return
+
+    field = sender._meta.get_field('client')
+    if hasattr(field, 'is_cached'):
+        client_loaded = field.is_cached(instance)
+    else:  # Django < 2.0
+        client_loaded = hasattr(instance, field.get_cache_name())
+
+    if client_loaded and not instance.client.reuse_client_credentials_token:
+        return
+
+    evict(partial(client_credentials_token_cache.delete, instance.client_id, instance.scope), using)
+
+
+@receiver(post_save, sender=Consent)
+@receiver(post_delete, sender=Consent)
+def evict_consent(sender, instance, using=None, **kwargs):
+    evict(partial(consent_cache.delete, instance.user_id, instance.client_id), using)
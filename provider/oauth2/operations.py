@@ -0,0 +1,104 @@
+"""
+Migration operations used by the ``oauth2`` migrations.
+"""
+
+import django
+from django.db import migrations
+
+
+class AddFieldIndexConcurrently(migrations.AlterField):
+    """
+    Alter a field to add ``db_index`` or ``unique``. On PostgreSQL the index
+    is built with ``CREATE INDEX CONCURRENTLY``, which does not lock the table
+    against writes, so it can run on large live tables. Migrations using it
+    must set ``atomic = False``. Other databases alter the field as usual.
+
+    The resulting schema matches the one of a plain ``AlterField``: unique
+    indexes are attached as constraints and ``varchar`` and ``text`` columns
+    get the ``_like`` index used by ``LIKE`` lookups. A failed concurrent
+    build leaves an invalid index behind, which is rebuilt when the migration
+    runs again.
+    """
+
+    def _get_index_name(self, schema_editor, model, column, suffix):
+        if django.VERSION < (2, 0):
+            return schema_editor._create_index_name(model, [column], suffix=suffix)
+        return schema_editor._create_index_name(model._meta.db_table, [column], suffix=suffix)
+
+    def _get_indexes(self, schema_editor, model):
+        """
+        Return ``(name, columns, unique)`` tuples of the indexes of the field.
+        """
+        field = model._meta.get_field(self.name)
+        column = schema_editor.quote_name(field.column)
+        suffix = '_uniq' if field.unique else ''
+        indexes = [(self._get_index_name(schema_editor, model, field.column, suffix), column, field.unique)]
+
+        db_type = field.db_type(connection=schema_editor.connection) or ''
+        if '[' not in db_type:
+            opclass = ('varchar_pattern_ops' if db_type.startswith('varchar') else
+                       'text_pattern_ops' if db_type.startswith('text') else None)
+            if opclass:
+                name = self._get_index_name(schema_editor, model, field.column, '_like')
+                indexes.append((name, '%s %s' % (column, opclass), False))
+
+        return indexes
+
+    def _fetch(self, schema_editor, sql, params):
+        if schema_editor.collect_sql:
+            return None
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def _create_index(self, schema_editor, model, name, columns, unique):
+        quote_name = schema_editor.quote_name
+        table = model._meta.db_table
+
+        valid = self._fetch(schema_editor, 'SELECT i.indisvalid FROM pg_index i '
+                                           'JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s', [name])
+        if valid is False:
+            # Left behind by a failed build, e.g. on duplicate values.
+            schema_editor.execute('DROP INDEX CONCURRENTLY %s' % quote_name(name))
+        if not valid:
+            schema_editor.execute('CREATE %sINDEX CONCURRENTLY %s ON %s (%s)' % (
+                'UNIQUE ' if unique else '', quote_name(name), quote_name(table), columns))
+
+        if unique and not self._fetch(schema_editor, 'SELECT 1 FROM pg_constraint WHERE conname = %s', [name]):
+            schema_editor.execute('ALTER TABLE %s ADD CONSTRAINT %s UNIQUE USING INDEX %s' % (
+                quote_name(table), quote_name(name), quote_name(name)))
+
+    def _drop_index(self, schema_editor, model, name, unique):
+        quote_name = schema_editor.quote_name
+        if unique:
+            schema_editor.execute('ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s' % (
+                quote_name(model._meta.db_table), quote_name(name)))
+        schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s' % quote_name(name))
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super(AddFieldIndexConcurrently, self).database_forwards(
+                app_label, schema_editor, from_state, to_state)
+
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        for name, columns, unique in self._get_indexes(schema_editor, model):
+            self._create_index(schema_editor, model, name, columns, unique)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            return super(AddFieldIndexConcurrently, self).database_backwards(
+                app_label, schema_editor, from_state, to_state)
+
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+
+        for name, columns, unique in self._get_indexes(schema_editor, model):
+            self._drop_index(schema_editor, model, name, unique)
+
+    def describe(self):
+        return "Concurrently index field %s on %s" % (self.name, self.model_name)
@@ -0,0 +1,121 @@
+"""
+Storage for authorization codes (:class:`provider.oauth2.models.Grant`). The
+store in use is configured with :attr:`provider.constants.GRANT_STORE`.
+
+Grants are short lived and used once, so they do not have to live in the
+database. :class:`CacheGrantStore` keeps them in the provider cache instead.
+"""
+
+from datetime import timedelta
+
+from django.utils.module_loading import import_string
+
+from provider import constants
+from provider.oauth2.cache import get_cache, make_key
+from provider.oauth2.models import Grant
+from provider.utils import now
+
+
+def get_grant_store():
+    """
+    Return an instance of the grant store configured by
+    :attr:`provider.constants.GRANT_STORE`.
+    """
+    return import_string(constants.GRANT_STORE)()
+
+
+class GrantStore(object):
+    """
+    Base class of grant stores. Implementations must implement:
+
+    * :meth:`save`
+    * :meth:`get`
+    * :meth:`invalidate`
+    """
+
+    def save(self, grant):
+        """
+        Store a new ``grant``.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def get(self, code, client):
+        """
+        Return the unexpired grant with the given ``code`` issued to
+        ``client`` or raise :class:`Grant.DoesNotExist`. Stores may consume
+        the grant right away, so that a second call fails.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def invalidate(self, grant):
+        """
+        Make sure ``grant`` cannot be used again once it was exchanged. Return
+        ``False`` if it was used or expired in the meantime.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class DatabaseGrantStore(GrantStore):
+    """
+    Default grant store, keeping grants in the database.
+    """
+
+    def save(self, grant):
+        grant.save()
+
+    def get(self, code, client):
+        return Grant.objects.select_related('user').get(code=code, client=client, expires__gt=now())
+
+    def invalidate(self, grant):
+        # A single conditional statement, so that of two concurrent exchanges
+        # of the same code only one affects the row.
+        unused = Grant.objects.filter(pk=grant.pk, expires__gt=now())
+        if constants.DELETE_EXPIRED:
+            count, _ = unused.delete()
+        else:
+            grant.expires = now() - timedelta(days=1)
+            count = unused.update(expires=grant.expires)
+        return count == 1
+
+
+class CacheGrantStore(GrantStore):
+    """
+    Grant store keeping grants in the provider cache until they expire, with
+    no database writes. :meth:`get` consumes the grant: concurrent requests
+    race for an atomic ``add`` of a marker key and only the winner gets the
+    grant. Returned grants are unsaved model instances.
+
+    Grants are lost if the cache is cleared or evicts them, so the cache must
+    be shared between processes and should not be under memory pressure.
+    """
+    prefix = 'grant'
+    consumed_prefix = 'grant_consumed'
+    fields = ('user_id', 'client_id', 'code', 'nonce', 'expires', 'redirect_uri', 'scope')
+
+    def save(self, grant):
+        timeout = int((grant.expires - now()).total_seconds())
+        if timeout <= 0:
+            return
+        entry = dict((field, getattr(grant, field)) for field in self.fields)
+        get_cache().set(make_key(self.prefix, grant.code), entry, timeout)
+
+    def get(self, code, client):
+        cache = get_cache()
+        key = make_key(self.prefix, code)
+        entry = cache.get(key)
+
+        if entry is None or entry['client_id'] != client.pk or entry['expires'] <= now():
+            raise Grant.DoesNotExist
+
+        timeout = int((entry['expires'] - now()).total_seconds()) + 1
+        if not cache.add(make_key(self.consumed_prefix, code), True, timeout):
+            raise Grant.DoesNotExist
+        cache.delete(key)
+
+        grant = Grant(**entry)
+        grant.client = client
+        return grant
+
+    def invalidate(self, grant):
+        # Consumed by get() already.
+        return True
@@ -5,24 +5,37 @@ import base64
 import datetime
 import json
 import six
+import threading
+import time
 import uuid
 from six.moves.urllib.parse import urlparse, parse_qs
 
 import ddt
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.http import QueryDict
-from django.test import TestCase, RequestFactory, override_settings
+from django.db import connection, transaction
+from django.db.backends.base.schema import BaseDatabaseSchemaEditor
+from django.db.migrations.loader import MigrationLoader
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils.html import escape
 from mock import patch
 
 from provider import constants, scope
 from provider.oauth2.backends import AccessTokenBackend, BasicClientBackend, RequestParamsClientBackend, \
-    PublicPasswordBackend
-from provider.oauth2.forms import ClientForm
-from provider.oauth2.models import Client, Grant, AccessToken, RefreshToken
+    PublicPasswordBackend, SignedAccessTokenBackend, DispatchingClientBackend
+from provider.oauth2.cache import LocalCache, access_token_cache, client_cache, idempotency_cache, make_key
+from provider.oauth2.forms import ClientAuthForm, ClientForm, RefreshTokenGrantForm
+from provider.oauth2.models import Client, Consent, Grant, AccessToken, RefreshToken
+from provider.oauth2.operations import AddFieldIndexConcurrently
+from provider.oauth2.stores import DatabaseGrantStore, get_grant_store
+from provider.state import CacheStateStore, SessionStateStore, SignedCookieStateStore
+from provider.oauth2.views import AccessTokenView as OAuth2AccessTokenView, OAuth2AccessTokenMixin
 from provider.templatetags.scope import scopes
+from provider.tokens import checked_token, is_checked_token, is_signed_token
 from provider.utils import now as date_now, short_token, long_token
 
 
@@ -577,8 +590,10 @@ class AccessTokenTest(BaseOAuth2TestCase):
             'password': self.get_password() + 'invalid',
         })
 
+        # The client is identified without checking the password; the
+        # password grant itself is then rejected.
         self.assertEqual(400, response.status_code, response.content)
-        self.assertEqual('invalid_client', json.loads(response.content.decode())['error'])
+        self.assertEqual('invalid_grant', json.loads(response.content.decode())['error'])
 
     def test_password_grant_invalid_password_confidential(self):
         c = self.get_client()
@@ -671,6 +686,139 @@ class ClientCredentialsAccessTokenTests(BaseOAuth2TestCase):
         self.assertEqual(400, response.status_code, response.content)
         self.assertDictEqual(json.loads(response.content.decode()), {'error': 'invalid_client'})
 
+    def enable_token_reuse(self):
+        reuse = patch('provider.constants.CLIENT_CREDENTIALS_TOKEN_REUSE', True)
+        reuse.start()
+        self.addCleanup(reuse.stop)
+        cache.clear()
+        client = self.get_client()
+        client.reuse_client_credentials_token = True
+        client.save()
+
+    def test_reuse_client_credentials_token(self):
+        self.enable_token_reuse()
+        response1 = self.request_access_token()
+        response2 = self.request_access_token()
+
+        self.assertEqual(json.loads(response1.content.decode())['access_token'],
+                         json.loads(response2.content.decode())['access_token'])
+        self.assertEqual(AccessToken.objects.count(), 1)
+
+    @patch('provider.constants.CLIENT_CREDENTIALS_TOKEN_REUSE_THRESHOLD', 1)
+    def test_reuse_client_credentials_token_threshold(self):
+        self.enable_token_reuse()
+        self.request_access_token()
+        self.request_access_token()
+
+        self.assertEqual(AccessToken.objects.count(), 2)
+
+    def test_invalidated_client_credentials_token_is_not_reused(self):
+        self.enable_token_reuse()
+        self.request_access_token()
+        OAuth2AccessTokenMixin().invalidate_access_token(self.get_latest_access_token())
+
+        response = self.request_access_token()
+
+        self.assertEqual(AccessToken.objects.count(), 2)
+        self.assert_valid_access_token_response(self.get_latest_access_token(), response)
+
+    def test_reuse_disabled(self):
+        self.enable_token_reuse()
+        self.request_access_token()
+
+        with patch('provider.constants.CLIENT_CREDENTIALS_TOKEN_REUSE', False), \
+                patch('provider.oauth2.models.client_credentials_token_cache.delete') as delete:
+            response = self.request_access_token()
+            OAuth2AccessTokenMixin().invalidate_access_token(AccessToken.objects.get(token=json.loads(
+                response.content.decode())['access_token']))
+
+        self.assertEqual(AccessToken.objects.count(), 2)
+        self.assertFalse(delete.called)
+
+    def test_deleted_expired_tokens_are_not_evicted(self):
+        self.enable_token_reuse()
+        self.request_access_token()
+        AccessToken.objects.update(expires=date_now() - datetime.timedelta(days=1))
+
+        with patch('provider.oauth2.models.client_credentials_token_cache.delete') as delete:
+            AccessToken.objects.get().delete()
+
+        self.assertFalse(delete.called)
+
+    def test_tokens_of_clients_without_reuse_are_not_evicted(self):
+        self.enable_token_reuse()
+        client = self.get_client()
+        client.reuse_client_credentials_token = False
+        client.save()
+        self.request_access_token()
+        access_token = AccessToken.objects.select_related('client').get()
+
+        with patch('provider.oauth2.models.client_credentials_token_cache.delete') as delete:
+            OAuth2AccessTokenMixin().invalidate_access_token(access_token)
+
+        self.assertFalse(delete.called)
+
+
+class TokenIssuanceQueryBudgetTest(TransactionTestCase):
+    """
+    Database round-trips per grant type with a warm client registry:
+
+    * ``authorization_code``: select grant and user, expire grant, insert
+      access and refresh token -- 4
+    * ``refresh_token``: select refresh token, access token and user, expire
+      both old tokens, insert access and refresh token -- 5
+    * ``password`` (confidential client): select user, insert access and
+      refresh token -- 3
+    * ``password`` (public client): select user, insert access token -- 2
+    * ``client_credentials``: insert access token -- 1
+
+    Each grant runs in a single transaction.
+    """
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(TokenIssuanceQueryBudgetTest, self).setUp()
+        patcher = patch('provider.constants.CLIENT_CACHE_TIMEOUT', 60)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        self.oauth_client = Client.objects.get_by_client_id(Client.objects.get(id=2).client_id)
+
+    def assertQueryBudget(self, budget):
+        # SQLite opens transactions with an explicit, logged BEGIN.
+        if connection.vendor == 'sqlite':
+            budget += 1
+        return self.assertNumQueries(budget)
+
+    def request_token(self, budget, **data):
+        data.setdefault('client_id', self.oauth_client.client_id)
+        if self.oauth_client.client_type == constants.CONFIDENTIAL:
+            data.setdefault('client_secret', self.oauth_client.client_secret)
+
+        with self.assertQueryBudget(budget):
+            response = self.client.post(reverse('oauth2:access_token'), data)
+
+        self.assertEqual(200, response.status_code, response.content)
+        return json.loads(response.content.decode())
+
+    def test_authorization_code(self):
+        grant = Grant.objects.create(user=User.objects.get(id=1), client=self.oauth_client, scope=constants.READ)
+        self.request_token(4, grant_type='authorization_code', code=grant.code)
+
+    def test_refresh_token(self):
+        token = self.request_token(3, grant_type='password', username='test-user-1', password='test')
+        self.request_token(5, grant_type='refresh_token', refresh_token=token['refresh_token'])
+
+    def test_public_password(self):
+        self.oauth_client.client_type = constants.PUBLIC
+        self.oauth_client.save()
+        self.oauth_client = Client.objects.get_by_client_id(self.oauth_client.client_id)
+
+        self.request_token(2, grant_type='password', username='test-user-1', password='test')
+
+    def test_client_credentials(self):
+        self.request_token(1, grant_type='client_credentials')
+
 
 class AuthBackendTest(BaseOAuth2TestCase):
     fixtures = ['test_oauth2']
@@ -723,6 +871,39 @@ class AuthBackendTest(BaseOAuth2TestCase):
         self.assertIsNone(RequestParamsClientBackend().authenticate(request))
         self.assertIsNone(PublicPasswordBackend().authenticate(request))
 
+    def test_dispatching_client_backend(self):
+        client = self.get_client()
+        factory = RequestFactory()
+        backend = DispatchingClientBackend()
+
+        auth = "Basic " + base64.b64encode("{0}:{1}".format(
+            client.client_id, client.client_secret).encode()).decode()
+        self.assertEqual(backend.authenticate(factory.post('', HTTP_AUTHORIZATION=auth)), client)
+
+        params = {'client_id': client.client_id, 'client_secret': client.client_secret}
+        self.assertEqual(backend.authenticate(factory.post('', params)), client)
+        self.assertIsNone(backend.authenticate(factory.get('', params)))
+        self.assertIsNone(backend.authenticate(factory.post('', dict(params, client_secret='invalid'))))
+        self.assertIsNone(backend.authenticate(factory.post('', {})))
+        self.assertIsNone(backend.authenticate(None))
+
+    def test_dispatching_client_backend_public_password(self):
+        client = self.get_client()
+        factory = RequestFactory()
+        backend = DispatchingClientBackend()
+        params = {'grant_type': 'password', 'client_id': client.client_id}
+
+        # Confidential clients need their secret.
+        self.assertIsNone(backend.authenticate(factory.post('', params)))
+
+        client.client_type = constants.PUBLIC
+        client.save()
+
+        # A single query identifies the client; no password is hashed.
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.authenticate(factory.post('', params)), client)
+        self.assertIsNone(backend.authenticate(factory.post('', dict(params, grant_type='client_credentials'))))
+
     def test_access_token_backend(self):
         user = self.get_user()
         client = self.get_client()
@@ -740,6 +921,985 @@ class AuthBackendTest(BaseOAuth2TestCase):
         self.assertIsNone(authenticated)
 
 
+@patch('provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT', 60)
+class AccessTokenCacheTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(AccessTokenCacheTest, self).setUp()
+        cache.clear()
+        self.access_token = AccessToken.objects.create(user=self.get_user(), client=self.get_client())
+
+    def test_get_token_is_read_through(self):
+        AccessToken.objects.get_token(self.access_token.token)
+
+        with self.assertNumQueries(0):
+            token = AccessToken.objects.get_token(self.access_token.token)
+            self.assertEqual(token.user.username, 'test-user-1')
+
+    def test_password_is_not_cached(self):
+        AccessToken.objects.get_token(self.access_token.token)
+        AccessToken.objects.get_tokens([self.access_token.token])
+
+        cached = access_token_cache.get(self.access_token.token)
+        self.assertIn('password', cached.user.get_deferred_fields())
+
+    def test_access_token_backend_uses_cache(self):
+        backend = AccessTokenBackend()
+        client = self.get_client()
+        other_client = Client.objects.get(pk=1)
+        backend.authenticate(access_token=self.access_token.token, client=client)
+
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(backend.authenticate(access_token=self.access_token.token, client=client))
+            self.assertIsNone(backend.authenticate(access_token=self.access_token.token, client=other_client))
+
+    def test_invalidated_token_is_evicted(self):
+        AccessToken.objects.get_token(self.access_token.token)
+
+        OAuth2AccessTokenMixin().invalidate_access_token(self.access_token)
+
+        with self.assertRaises(AccessToken.DoesNotExist):
+            AccessToken.objects.get_token(self.access_token.token)
+
+    def test_deleted_token_is_evicted(self):
+        AccessToken.objects.get_token(self.access_token.token)
+
+        self.access_token.delete()
+
+        with self.assertRaises(AccessToken.DoesNotExist):
+            AccessToken.objects.get_token(self.access_token.token)
+
+    def test_timeout_is_capped_at_token_lifetime(self):
+        self.access_token.expires = date_now() + datetime.timedelta(seconds=10)
+        self.access_token.save()
+
+        with patch.object(cache, 'set') as mock_set:
+            AccessToken.objects.get_token(self.access_token.token)
+
+        self.assertLessEqual(mock_set.call_args[0][2], 10)
+
+    def test_cache_disabled(self):
+        with patch('provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT', 0):
+            AccessToken.objects.get_token(self.access_token.token)
+
+            with self.assertNumQueries(1):
+                AccessToken.objects.get_token(self.access_token.token)
+
+    def test_get_reusable_token_is_read_through(self):
+        user, client, scope = self.access_token.user, self.access_token.client, self.access_token.scope
+        AccessToken.objects.get_reusable_token(user, client, scope)
+
+        with self.assertNumQueries(0):
+            token = AccessToken.objects.get_reusable_token(user, client, scope)
+            self.assertEqual(token.token, self.access_token.token)
+
+    def test_get_reusable_token_skips_invalidated_token(self):
+        user, client, scope = self.access_token.user, self.access_token.client, self.access_token.scope
+        AccessToken.objects.get_reusable_token(user, client, scope)
+
+        OAuth2AccessTokenMixin().invalidate_access_token(self.access_token)
+
+        with self.assertRaises(AccessToken.DoesNotExist):
+            AccessToken.objects.get_reusable_token(user, client, scope)
+
+
+@patch('provider.constants.SINGLE_ACCESS_TOKEN', True)
+@patch('provider.constants.ATOMIC_SINGLE_ACCESS_TOKEN', True)
+class AtomicSingleAccessTokenTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(AtomicSingleAccessTokenTest, self).setUp()
+        self.user = self.get_user()
+        self.oauth_client = self.get_client()
+        self.reuse_key = AccessToken.get_reuse_key(self.user.pk, self.oauth_client.pk, constants.READ)
+
+    def get_access_token(self):
+        return OAuth2AccessTokenMixin().get_access_token(None, self.user, constants.READ, self.oauth_client)
+
+    def test_creates_token_holding_reuse_key(self):
+        access_token = self.get_access_token()
+
+        self.assertEqual(access_token.reuse_key, self.reuse_key)
+        self.assertEqual(self.get_access_token(), access_token)
+        self.assertEqual(AccessToken.objects.count(), 1)
+
+    def test_concurrently_created_token_is_reused(self):
+        # Another request claimed the key between our lookup and our insert.
+        other = AccessToken.objects.create(user=self.user, client=self.oauth_client, scope=constants.READ,
+                                           reuse_key=self.reuse_key)
+
+        with patch.object(AccessToken.objects, 'get_reusable_token', side_effect=AccessToken.DoesNotExist):
+            access_token = self.get_access_token()
+
+        self.assertEqual(access_token, other)
+        self.assertEqual(AccessToken.objects.count(), 1)
+
+    def test_expired_token_releases_reuse_key(self):
+        expired = AccessToken.objects.create(user=self.user, client=self.oauth_client, scope=constants.READ,
+                                             reuse_key=self.reuse_key,
+                                             expires=date_now() - datetime.timedelta(days=1))
+
+        access_token = self.get_access_token()
+
+        self.assertNotEqual(access_token, expired)
+        self.assertEqual(access_token.reuse_key, self.reuse_key)
+        self.assertIsNone(AccessToken.objects.get(pk=expired.pk).reuse_key)
+
+    def test_invalidated_token_releases_reuse_key(self):
+        access_token = self.get_access_token()
+
+        OAuth2AccessTokenMixin().invalidate_access_token(access_token)
+
+        self.assertIsNone(AccessToken.objects.get(pk=access_token.pk).reuse_key)
+        self.assertNotEqual(self.get_access_token(), access_token)
+
+    def test_password_grant(self):
+        data = {
+            'grant_type': 'password',
+            'username': 'test-user-1',
+            'password': 'test',
+            'client_id': self.oauth_client.client_id,
+            'client_secret': self.oauth_client.client_secret,
+            'scope': 'read',
+        }
+        response1 = self.client.post(self.access_token_url(), data)
+        response2 = self.client.post(self.access_token_url(), data)
+
+        self.assertEqual(200, response1.status_code, response1.content)
+        self.assertEqual(json.loads(response1.content.decode())['access_token'],
+                         json.loads(response2.content.decode())['access_token'])
+        self.assertEqual(AccessToken.objects.count(), 1)
+
+
+@patch('provider.constants.REFRESH_TOKEN_GRACE_PERIOD', 30)
+class RefreshTokenGracePeriodTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(RefreshTokenGracePeriodTest, self).setUp()
+        self.oauth_client = self.get_client()
+        self.token = self.request_token(grant_type='password', username='test-user-1', password='test')
+
+    def request_token(self, **data):
+        data.setdefault('client_id', self.oauth_client.client_id)
+        data.setdefault('client_secret', self.oauth_client.client_secret)
+        return self.client.post(self.access_token_url(), data)
+
+    def refresh(self, token):
+        return self.request_token(grant_type='refresh_token', refresh_token=token['refresh_token'])
+
+    def test_replay_returns_issued_tokens(self):
+        response1 = self.refresh(json.loads(self.token.content.decode()))
+        response2 = self.refresh(json.loads(self.token.content.decode()))
+
+        self.assertEqual(200, response2.status_code, response2.content)
+        token1 = json.loads(response1.content.decode())
+        token2 = json.loads(response2.content.decode())
+        self.assertEqual(token1['access_token'], token2['access_token'])
+        self.assertEqual(token1['refresh_token'], token2['refresh_token'])
+        self.assertEqual(AccessToken.objects.count(), 2)
+        self.assertEqual(RefreshToken.objects.count(), 2)
+
+    def test_replay_after_grace_period(self):
+        token = json.loads(self.token.content.decode())
+        self.refresh(token)
+        RefreshToken.objects.filter(token=token['refresh_token']).update(
+            expired_at=date_now() - datetime.timedelta(seconds=31))
+
+        response = self.refresh(token)
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('invalid_grant', json.loads(response.content.decode())['error'])
+
+    def test_replay_after_successor_was_used(self):
+        token = json.loads(self.token.content.decode())
+        self.refresh(json.loads(self.refresh(token).content.decode()))
+
+        response = self.refresh(token)
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('invalid_grant', json.loads(response.content.decode())['error'])
+
+    def test_replay_without_select_for_update_of(self):
+        token = json.loads(self.token.content.decode())
+        features = connection.features
+
+        with patch.object(type(features), 'has_select_for_update_of', False, create=True):
+            response1 = self.refresh(token)
+            response2 = self.refresh(token)
+
+        self.assertEqual(200, response2.status_code, response2.content)
+        self.assertEqual(json.loads(response1.content.decode())['access_token'],
+                         json.loads(response2.content.decode())['access_token'])
+
+    def test_only_the_token_row_is_locked(self):
+        token = json.loads(self.token.content.decode())
+        features, ops = connection.features, connection.ops
+
+        # Mark locking reads with a comment, which SQLite accepts.
+        with patch.object(type(features), 'has_select_for_update', True), \
+                patch.object(type(features), 'has_select_for_update_of', False, create=True), \
+                patch.object(type(ops), 'for_update_sql', lambda *args, **kwargs: '/* FOR UPDATE */'), \
+                CaptureQueriesContext(connection) as queries:
+            self.refresh(token)
+            response = self.refresh(token)
+
+        self.assertEqual(200, response.status_code, response.content)
+        locked = [query['sql'] for query in queries if 'FOR UPDATE' in query['sql']]
+        self.assertEqual(len(locked), 2)
+        for sql in locked:
+            self.assertNotIn('JOIN', sql)
+
+    def test_disabled(self):
+        token = json.loads(self.token.content.decode())
+
+        with patch('provider.constants.REFRESH_TOKEN_GRACE_PERIOD', 0):
+            self.refresh(token)
+            response = self.refresh(token)
+
+        self.assertEqual(400, response.status_code)
+        self.assertIsNone(RefreshToken.objects.get(token=token['refresh_token']).successor)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+@patch('provider.constants.REFRESH_TOKEN_GRACE_PERIOD', 30)
+class ConcurrentRefreshTokenTest(TransactionTestCase):
+    """
+    Fires parallel refreshes of the same refresh token, which must all return
+    the same tokens. Needs a database with row locks.
+    """
+    fixtures = ['test_oauth2']
+    concurrency = 8
+
+    def test_parallel_refreshes(self):
+        oauth_client = Client.objects.get(id=2)
+        access_token = AccessToken.objects.create(user=User.objects.get(id=1), client=oauth_client)
+        refresh_token = RefreshToken.objects.create(user=access_token.user, client=oauth_client,
+                                                    access_token=access_token)
+        data = {
+            'grant_type': 'refresh_token',
+            'refresh_token': refresh_token.token,
+            'client_id': oauth_client.client_id,
+            'client_secret': oauth_client.client_secret,
+        }
+        start = threading.Event()
+        responses = []
+
+        def refresh():
+            start.wait()
+            try:
+                responses.append(self.client_class().post(reverse('oauth2:access_token'), data))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=refresh) for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([200] * self.concurrency, [response.status_code for response in responses])
+        tokens = set(json.loads(response.content.decode())['access_token'] for response in responses)
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(AccessToken.objects.count(), 2)
+
+
+@patch('provider.constants.IDEMPOTENCY_KEY_TIMEOUT', 60)
+class IdempotencyKeyTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(IdempotencyKeyTest, self).setUp()
+        cache.clear()
+        self.oauth_client = self.get_client()
+        self.data = {
+            'grant_type': 'password',
+            'username': 'test-user-1',
+            'password': 'test',
+            'client_id': self.oauth_client.client_id,
+            'client_secret': self.oauth_client.client_secret,
+        }
+
+    def request_token(self, idempotency_key='abc', **data):
+        params = dict(self.data, **data)
+        return self.client.post(self.access_token_url(), params, HTTP_IDEMPOTENCY_KEY=idempotency_key)
+
+    def test_replays_response_without_queries(self):
+        response1 = self.request_token()
+        self.assertEqual(200, response1.status_code, response1.content)
+
+        # Only the client lookup is left.
+        with self.assertNumQueries(1):
+            response2 = self.request_token()
+
+        self.assertEqual(response1.content, response2.content)
+        self.assertEqual(AccessToken.objects.count(), 1)
+
+    def test_keys_are_scoped_per_client(self):
+        other_client = Client.objects.create(user=self.get_user(), client_type=constants.CONFIDENTIAL,
+                                             redirect_uri='http://example.com/')
+        response1 = self.request_token()
+        response2 = self.request_token(client_id=other_client.client_id, client_secret=other_client.client_secret)
+
+        self.assertEqual(200, response2.status_code, response2.content)
+        self.assertNotEqual(response1.content, response2.content)
+
+    def test_key_reused_for_different_request(self):
+        self.request_token()
+        response = self.request_token(scope='write')
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('invalid_request', json.loads(response.content.decode())['error'])
+
+    def test_errors_are_not_stored(self):
+        self.assertEqual(400, self.request_token(password='wrong').status_code)
+
+        response = self.request_token()
+
+        self.assertEqual(200, response.status_code, response.content)
+
+    def get_fingerprint(self):
+        data = QueryDict('', mutable=True)
+        data.update(self.data)
+        return OAuth2AccessTokenView().get_request_fingerprint(data)
+
+    def test_concurrent_retry_is_rejected(self):
+        idempotency_cache.reserve(self.oauth_client.client_id, 'abc', self.get_fingerprint())
+
+        response = self.request_token()
+
+        self.assertEqual(409, response.status_code)
+        self.assertEqual(AccessToken.objects.count(), 0)
+
+    def test_fingerprint_is_keyed(self):
+        fingerprint = self.get_fingerprint()
+
+        with override_settings(SECRET_KEY='another secret'):
+            self.assertNotEqual(self.get_fingerprint(), fingerprint)
+
+    def test_without_key(self):
+        self.client.post(self.access_token_url(), self.data)
+        self.client.post(self.access_token_url(), self.data)
+
+        self.assertEqual(AccessToken.objects.count(), 2)
+
+
+@patch('provider.constants.MAX_ACTIVE_ACCESS_TOKENS', 2)
+class MaxActiveAccessTokensTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(MaxActiveAccessTokensTest, self).setUp()
+        self.user = self.get_user()
+        self.oauth_client = self.get_client()
+
+    def create_access_token(self, client=None):
+        return OAuth2AccessTokenMixin().create_access_token(None, self.user, constants.READ,
+                                                            client or self.oauth_client)
+
+    def get_active_tokens(self, client=None):
+        return set(AccessToken.objects.filter(client=client or self.oauth_client, expires__gt=date_now()))
+
+    def test_oldest_tokens_are_expired(self):
+        tokens = [self.create_access_token() for i in range(4)]
+
+        self.assertEqual(self.get_active_tokens(), set(tokens[2:]))
+        self.assertEqual(AccessToken.objects.count(), 4)
+
+    def test_tokens_of_other_clients_are_kept(self):
+        other_client = Client.objects.get(pk=1)
+        other_token = self.create_access_token(other_client)
+        for i in range(3):
+            self.create_access_token()
+
+        self.assertEqual(self.get_active_tokens(other_client), set([other_token]))
+
+    def test_expired_token_is_evicted(self):
+        self.create_access_token()
+        with patch('provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT', 60):
+            oldest = AccessToken.objects.get_token(self.create_access_token().token)
+            self.create_access_token()
+            self.create_access_token()
+
+            with self.assertRaises(AccessToken.DoesNotExist):
+                AccessToken.objects.get_token(oldest.token)
+
+    def test_single_update(self):
+        for i in range(3):
+            self.create_access_token()
+
+        # Insert the token and expire the surplus.
+        with self.assertNumQueries(2):
+            self.create_access_token()
+
+    @patch('provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT', 60)
+    def test_single_update_with_cache(self):
+        for i in range(3):
+            self.create_access_token()
+
+        # Insert the token, expire the surplus and read the expired tokens to
+        # evict them.
+        with self.assertNumQueries(3):
+            self.create_access_token()
+
+
+class DatabaseGrantStoreTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(DatabaseGrantStoreTest, self).setUp()
+        self.grant = Grant.objects.create(user=self.get_user(), client=self.get_client(), scope=constants.READ)
+
+    def test_invalidate_is_single_use(self):
+        store = DatabaseGrantStore()
+
+        with self.assertNumQueries(1):
+            self.assertTrue(store.invalidate(self.grant))
+        self.assertFalse(store.invalidate(self.grant))
+
+    @patch('provider.constants.DELETE_EXPIRED', True)
+    def test_invalidate_deletes(self):
+        store = DatabaseGrantStore()
+
+        self.assertTrue(store.invalidate(self.grant))
+        self.assertFalse(store.invalidate(self.grant))
+        self.assertFalse(Grant.objects.exists())
+
+    def test_concurrent_exchange(self):
+        # Another request exchanged the code after this one looked it up.
+        stale = Grant.objects.get(pk=self.grant.pk)
+        DatabaseGrantStore().invalidate(self.grant)
+
+        with patch.object(DatabaseGrantStore, 'get', return_value=stale):
+            response = self.client.post(self.access_token_url(), {
+                'grant_type': 'authorization_code',
+                'client_id': self.get_client().client_id,
+                'client_secret': self.get_client().client_secret,
+                'code': self.grant.code})
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('invalid_grant', json.loads(response.content.decode())['error'])
+        self.assertFalse(AccessToken.objects.exists())
+
+
+@patch('provider.constants.GRANT_STORE', 'provider.oauth2.stores.CacheGrantStore')
+class CacheGrantStoreTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(CacheGrantStoreTest, self).setUp()
+        cache.clear()
+
+    def get_code(self):
+        self.login()
+        self._login_and_authorize()
+        response = self.client.get(self.redirect_url())
+        return QueryDict(urlparse(response['Location']).query)['code']
+
+    def request_token(self, code):
+        return self.client.post(self.access_token_url(), {
+            'grant_type': 'authorization_code',
+            'client_id': self.get_client().client_id,
+            'client_secret': self.get_client().client_secret,
+            'code': code})
+
+    def test_authorization_code_flow(self):
+        code = self.get_code()
+
+        response = self.request_token(code)
+
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertEqual(Grant.objects.count(), 0)
+        self.assertEqual(AccessToken.objects.get().user, self.get_user())
+
+    def test_code_is_single_use(self):
+        code = self.get_code()
+        self.request_token(code)
+
+        response = self.request_token(code)
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('invalid_grant', json.loads(response.content.decode())['error'])
+
+    def test_code_of_other_client(self):
+        code = self.get_code()
+        other_client = Client.objects.get(pk=1)
+
+        with self.assertRaises(Grant.DoesNotExist):
+            get_grant_store().get(code, other_client)
+
+        # The code is still valid for its own client.
+        self.assertEqual(200, self.request_token(code).status_code)
+
+    def test_expired_code(self):
+        code = self.get_code()
+
+        with patch('provider.oauth2.stores.now', return_value=date_now() + constants.EXPIRE_CODE_DELTA):
+            response = self.request_token(code)
+
+        self.assertEqual(400, response.status_code)
+
+
+class LookupIndexTest(TestCase):
+    """
+    The hot lookups must be answered from an index on the looked up column.
+    """
+
+    def get_index_name(self, model, field_name):
+        column = model._meta.get_field(field_name).column
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+        for name, constraint in constraints.items():
+            if constraint['columns'] == [column] and (constraint['index'] or constraint['unique']):
+                return name
+        self.fail('%s.%s is not indexed' % (model.__name__, field_name))
+
+    def assertUsesIndex(self, queryset, field_name):
+        if not hasattr(queryset, 'explain'):
+            self.skipTest('QuerySet.explain() needs Django 2.1.')
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        elif connection.vendor != 'sqlite':
+            self.skipTest('Query plans are only checked on PostgreSQL and SQLite.')
+
+        index_name = self.get_index_name(queryset.model, field_name)
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+
+    def test_client_id(self):
+        self.assertUsesIndex(Client.objects.filter(client_id='abc'), 'client_id')
+
+    def test_access_token(self):
+        self.assertUsesIndex(AccessToken.objects.filter(token='abc'), 'token')
+
+    def test_refresh_token(self):
+        self.assertUsesIndex(RefreshToken.objects.filter(token='abc'), 'token')
+
+    def test_grant_code(self):
+        self.assertUsesIndex(Grant.objects.filter(code='abc'), 'code')
+
+
+class AddFieldIndexConcurrentlyTest(TestCase):
+    """
+    The PostgreSQL statements of the concurrent index operation, collected
+    instead of run.
+    """
+
+    def collect_sql(self, fetch):
+        loader = MigrationLoader(connection)
+        state = loader.project_state(('oauth2', '0010_add_lookup_indexes'))
+        operation = loader.get_migration('oauth2', '0010_add_lookup_indexes').operations[0]
+        schema_editor = BaseDatabaseSchemaEditor(connection, collect_sql=True)
+
+        with patch.object(connection, 'vendor', 'postgresql'), \
+                patch.object(AddFieldIndexConcurrently, '_fetch', side_effect=fetch):
+            operation.database_forwards('oauth2', schema_editor, state, state)
+
+        return [sql.rstrip(';') for sql in schema_editor.collected_sql]
+
+    def test_new_index(self):
+        self.assertEqual(self.collect_sql(lambda *args: None), [
+            'CREATE UNIQUE INDEX CONCURRENTLY "oauth2_client_client_id_64fa4445_uniq" '
+            'ON "oauth2_client" ("client_id")',
+            'ALTER TABLE "oauth2_client" ADD CONSTRAINT "oauth2_client_client_id_64fa4445_uniq" '
+            'UNIQUE USING INDEX "oauth2_client_client_id_64fa4445_uniq"',
+            'CREATE INDEX CONCURRENTLY "oauth2_client_client_id_64fa4445_like" '
+            'ON "oauth2_client" ("client_id" varchar_pattern_ops)',
+        ])
+
+    def test_invalid_index_is_rebuilt(self):
+        def fetch(schema_editor, sql, params):
+            return False if 'indisvalid' in sql else None
+
+        statements = self.collect_sql(fetch)
+
+        self.assertEqual(statements[0], 'DROP INDEX CONCURRENTLY "oauth2_client_client_id_64fa4445_uniq"')
+        self.assertTrue(statements[1].startswith('CREATE UNIQUE INDEX CONCURRENTLY'))
+
+    def test_existing_index(self):
+        self.assertEqual(self.collect_sql(lambda *args: 1), [])
+
+
+@ddt.ddt
+class AuthorizationStateStoreTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(AuthorizationStateStoreTest, self).setUp()
+        cache.clear()
+
+    def get_token(self):
+        self.login()
+        self._login_and_authorize()
+        response = self.client.get(self.redirect_url())
+        code = QueryDict(urlparse(response['Location']).query)['code']
+
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'authorization_code',
+            'client_id': self.get_client().client_id,
+            'client_secret': self.get_client().client_secret,
+            'code': code})
+        self.assertEqual(200, response.status_code, response.content)
+
+    @ddt.data(SessionStateStore, CacheStateStore, SignedCookieStateStore)
+    def test_authorization_code_flow(self, store):
+        path = '%s.%s' % (store.__module__, store.__name__)
+        with patch('provider.constants.STATE_STORE', path), \
+                patch.object(store, 'save', autospec=True, side_effect=store.save) as save, \
+                patch.object(store, 'delete', autospec=True, side_effect=store.delete) as delete:
+            self.get_token()
+
+        # Captured and validated parameters, then the authorization; cleared
+        # on redirect.
+        self.assertEqual(save.call_count, 2)
+        self.assertEqual(delete.call_count, 1)
+        self.assertNotIn(constants.SESSION_KEY, self.client.session)
+
+    @ddt.data(CacheStateStore, SignedCookieStateStore)
+    def test_cookie_stores_do_not_use_the_session(self, store):
+        path = '%s.%s' % (store.__module__, store.__name__)
+        with patch('provider.constants.STATE_STORE', path):
+            self.login()
+            self.client.get(self.auth_url(), data=self.get_auth_params())
+
+            self.assertNotIn(constants.SESSION_KEY, self.client.session)
+            self.assertIn(constants.STATE_COOKIE_NAME, self.client.cookies)
+            self.assertEqual(200, self.client.get(self.auth_url2()).status_code)
+
+    @patch('provider.constants.STATE_STORE', 'provider.state.CacheStateStore')
+    def test_planted_state_id_is_not_used(self):
+        self.login()
+        self.client.cookies[constants.STATE_COOKIE_NAME] = 'planted'
+
+        self.client.get(self.auth_url(), data=self.get_auth_params())
+
+        self.assertNotEqual(self.client.cookies[constants.STATE_COOKIE_NAME].value, 'planted')
+        self.assertIsNone(cache.get(make_key(CacheStateStore.prefix, 'planted')))
+
+    @ddt.data(CacheStateStore, SignedCookieStateStore)
+    def test_state_of_another_user_is_ignored(self, store):
+        path = '%s.%s' % (store.__module__, store.__name__)
+        with patch('provider.constants.STATE_STORE', path):
+            self.login()
+            self._login_and_authorize()
+            state_cookie = self.client.cookies[constants.STATE_COOKIE_NAME].value
+
+            self.client.force_login(User.objects.get(username='test-user-2'))
+            self.client.cookies[constants.STATE_COOKIE_NAME] = state_cookie
+            response = self.client.get(self.redirect_url())
+
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('invalid_data', json.loads(response.content.decode())['error'])
+
+    def test_flow_in_legacy_session_keys(self):
+        self.login()
+        session = self.client.session
+        session['%s:params' % constants.SESSION_KEY] = self.get_auth_params()
+        session.save()
+
+        response = self.client.post(self.auth_url2(), {'authorize': True, 'scope': constants.SCOPES[0][1]})
+        self.assertEqual(302, response.status_code)
+        response = self.client.get(self.redirect_url())
+
+        self.assertIn('code', QueryDict(urlparse(response['Location']).query))
+        self.assertNotIn('%s:params' % constants.SESSION_KEY, self.client.session)
+
+    def test_legacy_session_keys_are_cleared(self):
+        self.login()
+        session = self.client.session
+        session['%s:code' % constants.SESSION_KEY] = 'abc'
+        session['%s:client' % constants.SESSION_KEY] = self.get_client().serialize()
+        session.save()
+
+        self.client.get(self.auth_url(), data=self.get_auth_params())
+
+        self.assertNotIn('%s:code' % constants.SESSION_KEY, self.client.session)
+        self.assertNotIn('%s:client' % constants.SESSION_KEY, self.client.session)
+
+    def test_client_is_stored_by_reference(self):
+        self.login()
+        self._login_and_authorize()
+
+        state = self.client.session[constants.SESSION_KEY]
+        self.assertEqual(state['client'], self.get_client().client_id)
+        self.assertNotIn(self.get_client().client_secret, json.dumps(state))
+
+    def test_redirect_with_legacy_serialized_client(self):
+        self.login()
+        session = self.client.session
+        session['%s:params' % constants.SESSION_KEY] = self.get_auth_params()
+        session['%s:code' % constants.SESSION_KEY] = 'abc'
+        session['%s:client' % constants.SESSION_KEY] = self.get_client().serialize()
+        session.save()
+
+        response = self.client.get(self.redirect_url())
+
+        self.assertEqual(302, response.status_code)
+        self.assertIn('code', QueryDict(urlparse(response['Location']).query))
+
+    def test_validated_request_is_memoized(self):
+        self.login()
+        self.client.get(self.auth_url(), data=self.get_auth_params(state='abc'))
+
+        with patch('provider.oauth2.views.Authorize.get_request_form') as get_request_form:
+            self.assertEqual(200, self.client.get(self.auth_url2()).status_code)
+            response = self.client.post(self.auth_url2(), {'authorize': True, 'scope': constants.SCOPES[0][1]})
+
+        self.assertEqual(302, response.status_code)
+        self.assertFalse(get_request_form.called)
+        response = self.client.get(self.redirect_url())
+        self.assertEqual(QueryDict(urlparse(response['Location']).query)['state'], 'abc')
+
+    def test_changed_client_is_validated_again(self):
+        self.login()
+        self.client.get(self.auth_url(), data=self.get_auth_params(redirect_uri=self.get_client().redirect_uri))
+        self.client.get(self.auth_url2())
+        client = self.get_client()
+        client.redirect_uri = 'http://example.com/changed'
+        client.save()
+
+        response = self.client.post(self.auth_url2(), {'authorize': True, 'scope': constants.SCOPES[0][1]})
+
+        self.assertEqual(400, response.status_code)
+        self.assertIn(escape("The requested redirect didn't match the client settings."),
+                      response.content.decode('utf-8'))
+
+    @patch('provider.constants.STATE_STORE', 'provider.state.SignedCookieStateStore')
+    def test_tampered_signed_cookie(self):
+        self.login()
+        self.client.get(self.auth_url(), data=self.get_auth_params())
+        self.client.cookies[constants.STATE_COOKIE_NAME] = self.client.cookies[constants.STATE_COOKIE_NAME].value + 'x'
+
+        response = self.client.get(self.auth_url2())
+
+        self.assertIn(b'Authorization session has expired.', response.content)
+
+
+@patch('provider.constants.REMEMBER_CONSENT', True)
+class RememberedConsentTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(RememberedConsentTest, self).setUp()
+        cache.clear()
+
+    def authorize(self, scope_name='read'):
+        self.client.get(self.auth_url(), data=self.get_auth_params(scope=scope_name))
+        return self.client.get(self.auth_url2())
+
+    def test_consent_is_remembered(self):
+        self.login()
+        self._login_and_authorize()
+
+        consent = Consent.objects.get(user=self.get_user(), client=self.get_client())
+        self.assertEqual(consent.scope, constants.READ)
+
+    def test_repeat_approval_skips_authorization_screen(self):
+        self.login()
+        self._login_and_authorize()
+        self.client.get(self.redirect_url())
+
+        response = self.authorize()
+
+        self.assertEqual(302, response.status_code)
+        self.assertIn(self.redirect_url(), response['Location'])
+        self.assertEqual(Grant.objects.count(), 2)
+
+    def test_cached_consent_check(self):
+        self.login()
+        self._login_and_authorize()
+        self.client.get(self.redirect_url())
+        user, client = self.get_user(), self.get_client()
+        Consent.objects.get_scope(user, client)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(Consent.objects.get_scope(user, client), constants.READ)
+
+    def test_broader_scope_shows_authorization_screen(self):
+        self.login()
+        self._login_and_authorize()
+        self.client.get(self.redirect_url())
+
+        response = self.authorize('read write')
+
+        self.assertEqual(200, response.status_code)
+        self.assertTemplateUsed(response, 'provider/authorize.html')
+
+    def test_broader_consent_is_merged(self):
+        Consent.objects.grant(self.get_user(), self.get_client(), constants.READ)
+        Consent.objects.grant(self.get_user(), self.get_client(), constants.WRITE)
+
+        consent = Consent.objects.get(user=self.get_user(), client=self.get_client())
+        self.assertEqual(consent.scope, constants.READ_WRITE)
+
+    def test_revoked_consent(self):
+        self.login()
+        self._login_and_authorize()
+        self.client.get(self.redirect_url())
+        Consent.objects.get_scope(self.get_user(), self.get_client())
+
+        Consent.objects.all().delete()
+
+        self.assertEqual(200, self.authorize().status_code)
+
+    def test_disabled(self):
+        self.login()
+        self._login_and_authorize()
+        self.client.get(self.redirect_url())
+
+        with patch('provider.constants.REMEMBER_CONSENT', False):
+            response = self.authorize()
+
+        self.assertEqual(200, response.status_code)
+
+
+class LocalCacheTest(TestCase):
+    def test_lru_eviction(self):
+        local = LocalCache(2)
+        local.set('a', 1, 60)
+        local.set('b', 2, 60)
+        local.get('a')
+        local.set('c', 3, 60)
+
+        self.assertEqual(local.get('a'), 1)
+        self.assertIsNone(local.get('b'))
+        self.assertEqual(local.get('c'), 3)
+        self.assertEqual(local.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+
+    def test_timeout(self):
+        local = LocalCache(2)
+        local.set('a', 1, 60)
+
+        with patch('provider.oauth2.cache.time.time', return_value=time.time() + 61):
+            self.assertIsNone(local.get('a'))
+
+    def test_returns_copies(self):
+        local = LocalCache(2)
+        local.set('a', {'value': 1}, 60)
+        local.get('a')['value'] = 2
+
+        self.assertEqual(local.get('a'), {'value': 1})
+
+
+@patch('provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT', 0)
+class TwoTierAccessTokenCacheTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(TwoTierAccessTokenCacheTest, self).setUp()
+        self.local = LocalCache(10)
+        patcher = patch.object(access_token_cache, 'local', self.local)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.access_token = AccessToken.objects.create(user=self.get_user(), client=self.get_client())
+
+    def test_local_tier_serves_hot_tokens(self):
+        AccessToken.objects.get_token(self.access_token.token)
+
+        with self.assertNumQueries(0):
+            AccessToken.objects.get_token(self.access_token.token)
+        self.assertEqual(self.local.hits, 1)
+
+    def test_local_tier_is_evicted(self):
+        AccessToken.objects.get_token(self.access_token.token)
+        self.access_token.delete()
+
+        with self.assertRaises(AccessToken.DoesNotExist):
+            AccessToken.objects.get_token(self.access_token.token)
+
+
+@patch('provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT', 60)
+@patch('provider.constants.CLIENT_CACHE_TIMEOUT', 60)
+class EvictOnCommitTest(TransactionTestCase):
+    """
+    A request reading a changed row before the change commits must not leave
+    the old row cached.
+    """
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(EvictOnCommitTest, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def test_access_token(self):
+        access_token = AccessToken.objects.create(user=User.objects.get(pk=1), client=Client.objects.get(pk=2))
+        stale = AccessToken.objects.get_token(access_token.token)
+
+        with transaction.atomic():
+            OAuth2AccessTokenMixin().invalidate_access_token(access_token)
+            # Cached again by a concurrent request before the commit.
+            access_token_cache.set(stale)
+
+        with self.assertRaises(AccessToken.DoesNotExist):
+            AccessToken.objects.get_token(access_token.token)
+
+    def test_client(self):
+        client = Client.objects.get(pk=2)
+
+        with transaction.atomic():
+            client.client_secret = 'rotated'
+            client.save()
+            # Cached again by a concurrent request before the commit.
+            _, version = client_cache.get(client.client_id)
+            client_cache.set(Client(pk=client.pk, client_id=client.client_id, client_secret='old'), version)
+
+        self.assertEqual(Client.objects.get_by_client_id(client.client_id).client_secret, 'rotated')
+
+
+@patch('provider.constants.CLIENT_CACHE_TIMEOUT', 60)
+class ClientCacheTest(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def setUp(self):
+        super(ClientCacheTest, self).setUp()
+        cache.clear()
+        self.oauth_client = self.get_client()
+
+    def test_lookup_is_cached(self):
+        Client.objects.get_by_client_id(self.oauth_client.client_id)
+
+        with self.assertNumQueries(0):
+            client = Client.objects.get_by_client_id(self.oauth_client.client_id)
+        self.assertEqual(client, self.oauth_client)
+
+    def test_password_is_not_cached(self):
+        Client.objects.get_by_client_id(self.oauth_client.client_id)
+
+        client, _ = client_cache.get(self.oauth_client.client_id)
+        self.assertIn('password', client.user.get_deferred_fields())
+
+    def test_save_invalidates(self):
+        Client.objects.get_by_client_id(self.oauth_client.client_id)
+
+        self.oauth_client.redirect_uri = 'http://example.com/changed/'
+        self.oauth_client.save()
+
+        client = Client.objects.get_by_client_id(self.oauth_client.client_id)
+        self.assertEqual(client.redirect_uri, 'http://example.com/changed/')
+
+    def test_delete_invalidates(self):
+        client_id = self.oauth_client.client_id
+        Client.objects.get_by_client_id(client_id)
+
+        self.oauth_client.delete()
+
+        with self.assertRaises(Client.DoesNotExist):
+            Client.objects.get_by_client_id(client_id)
+
+    def test_client_auth_form_uses_cache(self):
+        data = {'client_id': self.oauth_client.client_id, 'client_secret': self.oauth_client.client_secret}
+        self.assertTrue(ClientAuthForm(data).is_valid())
+
+        with self.assertNumQueries(0):
+            self.assertTrue(ClientAuthForm(data).is_valid())
+            self.assertFalse(ClientAuthForm(dict(data, client_secret='invalid')).is_valid())
+
+
 class EnforceSecureTest(BaseOAuth2TestCase):
     fixtures = ['test_oauth2']
 
@@ -928,6 +2088,198 @@ class AccessTokenDetailViewTests(TestCase):
         }
         self.assertEqual(json.loads(response.content.decode()), expected)
 
+    @patch('provider.constants.ACCESS_TOKEN_DETAIL_MAX_AGE', 300)
+    def test_caching_headers(self):
+        """ Successful responses may be cached privately, but not beyond the token's expiry. """
+        expires = date_now() + datetime.timedelta(seconds=100)
+        access_token = AccessToken.objects.create(user=self.user, client=self.oauth_client, expires=expires)
+        url = reverse('oauth2:access_token_detail', kwargs={'token': access_token.token})
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('private', response['Cache-Control'])
+        max_age = int(response['Cache-Control'].split('max-age=')[1])
+        self.assertTrue(0 < max_age <= 100, max_age)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_errors_are_not_cached(self):
+        url = reverse('oauth2:access_token_detail', kwargs={'token': 'abc'})
+        self.assertEqual(self.client.get(url)['Cache-Control'], 'no-store')
+
+
+@patch('provider.constants.ACCESS_TOKEN_NEGATIVE_CACHE_TIMEOUT', 60)
+class AccessTokenNegativeCacheTests(TestCase):
+    def setUp(self):
+        super(AccessTokenNegativeCacheTests, self).setUp()
+        cache.clear()
+        self.user = User.objects.create_user('TEST-USER', 'user@example.com')
+        self.oauth_client = Client.objects.create(client_type=constants.CONFIDENTIAL)
+
+    def get_detail(self, token):
+        return self.client.get(reverse('oauth2:access_token_detail', kwargs={'token': token}))
+
+    def test_unknown_token_is_remembered(self):
+        self.assertEqual(self.get_detail('abc').status_code, 400)
+
+        with self.assertNumQueries(0):
+            response = self.get_detail('abc')
+        self.assertEqual(json.loads(response.content.decode()), {'error': 'invalid_token'})
+
+    def test_creating_token_clears_negative_entry(self):
+        self.assertEqual(self.get_detail('abc').status_code, 400)
+
+        AccessToken.objects.create(user=self.user, client=self.oauth_client, token='abc')
+
+        self.assertEqual(self.get_detail('abc').status_code, 200)
+
+
+@patch('provider.constants.CHECKED_TOKENS', True)
+class CheckedTokenTests(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def forge(self, token):
+        """ Tamper with the last character of the HMAC. """
+        return token[:-1] + ('1' if token.endswith('0') else '0')
+
+    def test_issues_checked_tokens(self):
+        client = self.get_client()
+        mixin = OAuth2AccessTokenMixin()
+        at, rt = mixin.get_access_and_refresh_tokens(None, self.get_user(), constants.READ, client)
+
+        self.assertTrue(is_checked_token(at.token))
+        self.assertTrue(is_checked_token(rt.token))
+        self.assertEqual(AccessToken.objects.get_token(at.token), at)
+
+    def test_rejects_forged_access_token_without_query(self):
+        forged = self.forge(checked_token(date_now() + datetime.timedelta(days=1)))
+
+        with self.assertNumQueries(0):
+            with self.assertRaises(AccessToken.DoesNotExist):
+                AccessToken.objects.get_token(forged)
+
+    def test_rejects_forged_refresh_token_without_query(self):
+        client = self.get_client()
+        forged = self.forge(checked_token())
+        form = RefreshTokenGrantForm({'refresh_token': forged}, client=client)
+
+        with self.assertNumQueries(0):
+            self.assertFalse(form.is_valid())
+        self.assertEqual(form.errors, {'error': 'invalid_grant'})
+
+    def test_legacy_tokens_still_validate(self):
+        token = AccessToken.objects.create(user=self.get_user(), client=self.get_client())
+        self.assertEqual(AccessToken.objects.get_token(token.token), token)
+
+
+@patch('provider.constants.SIGNED_TOKENS', True)
+class SignedTokenTests(BaseOAuth2TestCase):
+    fixtures = ['test_oauth2']
+
+    def test_issues_signed_tokens(self):
+        client = self.get_client()
+        user = self.get_user()
+        at = OAuth2AccessTokenMixin().create_access_token(None, user, constants.READ, client)
+
+        with self.assertNumQueries(0):
+            authenticated = SignedAccessTokenBackend().authenticate(access_token=at.token, client=client)
+
+        self.assertEqual(authenticated.user_id, user.pk)
+        self.assertEqual(authenticated.scope, constants.READ)
+        self.assertIsNone(SignedAccessTokenBackend().authenticate(access_token=at.token,
+                                                                  client=Client.objects.get(pk=1)))
+        self.assertEqual(AccessToken.objects.get_token(at.token), at)
+
+    def test_refresh_token_flow(self):
+        token = json.loads(self.client.post(self.access_token_url(), {
+            'grant_type': 'password',
+            'client_id': self.get_client().client_id,
+            'client_secret': self.get_client().client_secret,
+            'username': self.get_user().username,
+            'password': self.get_password(),
+        }).content.decode())
+
+        response = self.client.post(self.access_token_url(), {
+            'grant_type': 'refresh_token',
+            'refresh_token': token['refresh_token'],
+            'client_id': self.get_client().client_id,
+            'client_secret': self.get_client().client_secret,
+        })
+
+        self.assertEqual(200, response.status_code, response.content)
+        self.assertTrue(is_signed_token(json.loads(response.content.decode())['access_token']))
+
+
+class AccessTokenBatchDetailViewTests(TestCase):
+    def setUp(self):
+        super(AccessTokenBatchDetailViewTests, self).setUp()
+        self.user = User.objects.create_user('TEST-USER', 'user@example.com')
+        self.oauth_client = Client.objects.create(client_type=constants.CONFIDENTIAL)
+        self.url = reverse('oauth2:access_token_batch_detail')
+
+    def create_token(self, **kwargs):
+        kwargs.setdefault('expires', datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        return AccessToken.objects.create(user=self.user, client=self.oauth_client, scope=constants.READ, **kwargs)
+
+    def test_batch(self):
+        valid = [self.create_token(), self.create_token()]
+        expired = self.create_token(expires=datetime.datetime.min)
+        tokens = [at.token for at in valid] + [expired.token, 'abc']
+
+        # One query resolves every token, joining the user.
+        with self.assertNumQueries(1):
+            response = self.client.post(self.url, {'token': tokens})
+
+        self.assertEqual(response.status_code, 200)
+        content = json.loads(response.content.decode())
+        for at in valid:
+            self.assertEqual(content[at.token], {
+                'username': self.user.username,
+                'scope': 'read',
+                'expires': at.expires.isoformat(),
+            })
+        self.assertEqual(content[expired.token], {'error': 'invalid_token'})
+        self.assertEqual(content['abc'], {'error': 'invalid_token'})
+
+    def test_get(self):
+        at = self.create_token()
+        response = self.client.get(self.url, {'token': [at.token]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode())[at.token]['username'], self.user.username)
+
+    def test_empty_batch(self):
+        response = self.client.post(self.url, {})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content.decode())['error'], 'invalid_request')
+
+    @patch('provider.constants.TOKEN_BATCH_MAX_SIZE', 2)
+    def test_max_batch_size(self):
+        response = self.client.post(self.url, {'token': ['a', 'b', 'c']})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content.decode())['error'], 'invalid_request')
+
+    @patch('provider.constants.ACCESS_TOKEN_CACHE_TIMEOUT', 60)
+    @patch('provider.constants.ACCESS_TOKEN_NEGATIVE_CACHE_TIMEOUT', 60)
+    def test_batch_uses_cache(self):
+        cache.clear()
+        at = self.create_token()
+        tokens = [at.token, 'abc']
+        self.client.post(self.url, {'token': tokens})
+
+        with self.assertNumQueries(0):
+            response = self.client.post(self.url, {'token': tokens})
+
+        content = json.loads(response.content.decode())
+        self.assertEqual(content[at.token]['username'], self.user.username)
+        self.assertEqual(content['abc'], {'error': 'invalid_token'})
+
 
 class TokensTestCase(TestCase):
     """Test that `short_token` and `long_token` functions work correctly
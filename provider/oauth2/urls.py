@@ -1,4 +1,4 @@
-"""
+r"""
 The default implementation of the OAuth provider includes two public endpoints
 that are meant for client (as defined in :rfc:`1`) interaction.
 
@@ -31,13 +31,25 @@ that are meant for client (as defined in :rfc:`1`) interaction.
 
     Errors are outlined in :rfc:`5.2`.
 
+.. attribute:: ^access_token/batch/$
+
+    This is the URL where a resource server looks up the details of several
+    access tokens at once. See
+    :class:`provider.oauth2.views.AccessTokenBatchDetailView`.
+
+.. attribute:: ^access_token/(?P<token>[\w]+)/$
+
+    This is the URL where a resource server looks up the details of a single
+    access token. See :class:`provider.oauth2.views.AccessTokenDetailView`.
+
 """
 
 from django.conf.urls import url
 from django.contrib.auth.decorators import login_required
 from django.views.decorators.csrf import csrf_exempt
 
-from provider.oauth2.views import Authorize, Redirect, Capture, AccessTokenView, AccessTokenDetailView
+from provider.oauth2.views import (Authorize, Redirect, Capture, AccessTokenView, AccessTokenDetailView,
+                                   AccessTokenBatchDetailView)
 
 urlpatterns = [
     url('^authorize/?$',
@@ -52,6 +64,9 @@ urlpatterns = [
     url('^access_token/?$',
         csrf_exempt(AccessTokenView.as_view()),
         name='access_token'),
+    url('^access_token/batch/?$',
+        csrf_exempt(AccessTokenBatchDetailView.as_view()),
+        name='access_token_batch_detail'),
     url('^access_token/(?P<token>[\w]+)/$',
         csrf_exempt(AccessTokenDetailView.as_view()),
         name='access_token_detail'),
@@ -1,43 +1,101 @@
 from datetime import timedelta
+import functools
 import json
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.http import HttpResponseBadRequest, HttpResponse
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control, set_response_etag
+from django.utils.crypto import salted_hmac
+from django.utils.translation import ugettext as _
 from django.views.generic import View
 
 from provider import constants
-from provider.oauth2.backends import BasicClientBackend, RequestParamsClientBackend, PublicPasswordBackend
+from provider import scope as scopes
+from provider.oauth2.backends import DispatchingClientBackend
 from provider.oauth2.forms import (AuthorizationCodeGrantForm, AuthorizationRequestForm, AuthorizationForm,
                                    PasswordGrantForm, RefreshTokenGrantForm, ClientCredentialsGrantForm)
-from provider.oauth2.models import Client, RefreshToken, AccessToken
+from provider.oauth2.cache import client_credentials_token_cache, idempotency_cache, single_access_token_cache
+from provider.oauth2.models import Client, Consent, RefreshToken, AccessToken
+from provider.oauth2.stores import get_grant_store
+from provider.tokens import checked_token, signed_token
 from provider.utils import now
 from provider.views import AccessToken as AccessTokenView, OAuthError, AccessTokenMixin, Capture, Authorize, Redirect
 
 
 class OAuth2AccessTokenMixin(AccessTokenMixin):
 
+    def get_access_and_refresh_tokens(self, *args, **kwargs):
+        # No savepoint is needed when a grant handler already runs in a transaction.
+        with transaction.atomic(savepoint=False):
+            return super(OAuth2AccessTokenMixin, self).get_access_and_refresh_tokens(*args, **kwargs)
+
     def get_access_token(self, request, user, scope, client):
         try:
             # Attempt to fetch an existing access token.
-            at = AccessToken.objects.get(user=user, client=client, scope=scope, expires__gt=now())
+            at = AccessToken.objects.get_reusable_token(user, client, scope)
         except AccessToken.DoesNotExist:
             # None found... make a new one!
-            at = self.create_access_token(request, user, scope, client)
+            if constants.ATOMIC_SINGLE_ACCESS_TOKEN:
+                at, created = AccessToken.objects.get_or_create_reusable_token(
+                    user, client, scope, self.get_access_token_defaults(request, user, scope, client))
+                if created:
+                    self.set_no_refresh_token(at)
+                    self.expire_surplus_access_tokens(user, client)
+            else:
+                at = self.create_access_token(request, user, scope, client)
+            single_access_token_cache.set(at)
         return at
 
+    def get_access_token_defaults(self, request, user, scope, client):
+        """
+        Return the field values of a new access token besides its user,
+        client and scope.
+        """
+        expires = client.get_default_token_expiry()
+
+        defaults = {'expires': expires}
+        if constants.SIGNED_TOKENS:
+            defaults['token'] = signed_token(user.pk, client.pk, scope, expires)
+        elif constants.CHECKED_TOKENS:
+            defaults['token'] = checked_token(expires)
+        return defaults
+
+    def set_no_refresh_token(self, at):
+        # A new token has no refresh token yet. Remember that, so building the
+        # token response does not have to look it up.
+        related = AccessToken.refresh_token.related
+        if hasattr(related, 'set_cached_value'):
+            related.set_cached_value(at, None)
+        else:  # Django < 2.0
+            setattr(at, related.get_cache_name(), None)
+
     def create_access_token(self, request, user, scope, client):
-        return AccessToken.objects.create(
+        at = AccessToken.objects.create(
             user=user,
             client=client,
-            scope=scope
+            scope=scope,
+            **self.get_access_token_defaults(request, user, scope, client)
         )
+        self.set_no_refresh_token(at)
+        self.expire_surplus_access_tokens(user, client)
+        return at
+
+    def expire_surplus_access_tokens(self, user, client):
+        if constants.MAX_ACTIVE_ACCESS_TOKENS:
+            AccessToken.objects.expire_surplus_tokens(user, client, constants.MAX_ACTIVE_ACCESS_TOKENS)
 
     def create_refresh_token(self, request, user, scope, access_token, client):
+        kwargs = {}
+        if constants.CHECKED_TOKENS:
+            kwargs['token'] = checked_token()
+
         return RefreshToken.objects.create(
             user=user,
             access_token=access_token,
-            client=client
+            client=client,
+            **kwargs
         )
 
     def invalidate_refresh_token(self, rt):
@@ -45,18 +103,48 @@ class OAuth2AccessTokenMixin(AccessTokenMixin):
             rt.delete()
         else:
             rt.expired = True
-            rt.save()
+            rt.expired_at = now()
+            rt.save(update_fields=['expired', 'expired_at'])
+
+    def get_replayed_access_token(self, rt):
+        if rt.expired and rt.in_grace_period():
+            return rt.successor.access_token
+        return None
+
+    def set_refresh_token_successor(self, rt, successor):
+        # Only needed to answer replays, and deleted tokens cannot be replayed.
+        if constants.REFRESH_TOKEN_GRACE_PERIOD and not constants.DELETE_EXPIRED:
+            rt.successor = successor
+            rt.save(update_fields=['successor'])
 
     def invalidate_access_token(self, at):
         if constants.DELETE_EXPIRED:
             at.delete()
         else:
             at.expires = now() - timedelta(milliseconds=1)
-            at.save()
+            # Release the reuse key right away, so a new token can claim it.
+            at.reuse_key = None
+            at.save(update_fields=['expires', 'reuse_key'])
 
 
 
-class Capture(Capture):
+class OAuth2AuthorizationRequestMixin(object):
+    """
+    Validation of captured authorization requests, shared by
+    :class:`Capture` and :class:`Authorize`.
+    """
+
+    def get_request_form(self, client, data):
+        return AuthorizationRequestForm(data, client=client)
+
+    def get_client(self, client_id):
+        try:
+            return Client.objects.get_by_client_id(client_id)
+        except Client.DoesNotExist:
+            return None
+
+
+class Capture(OAuth2AuthorizationRequestMixin, Capture):
     """
     Implementation of :class:`provider.views.Capture`.
     """
@@ -64,27 +152,39 @@ class Capture(Capture):
     def get_redirect_url(self, request):
         return reverse('oauth2:authorize')
 
+    def validate_request(self, request, data):
+        client = self.get_client(data.get('client_id'))
+        if client is None:
+            return None
+
+        form = self.get_request_form(client, data)
+        if not form.is_valid():
+            return None
 
-class Authorize(Authorize, OAuth2AccessTokenMixin):
+        return client, form.cleaned_data
+
+
+class Authorize(OAuth2AuthorizationRequestMixin, Authorize, OAuth2AccessTokenMixin):
     """
     Implementation of :class:`provider.views.Authorize`.
     """
 
-    def get_request_form(self, client, data):
-        return AuthorizationRequestForm(data, client=client)
-
     def get_authorization_form(self, request, client, data, client_data):
         return AuthorizationForm(data)
 
-    def get_client(self, client_id):
-        try:
-            return Client.objects.get(client_id=client_id)
-        except Client.DoesNotExist:
-            return None
-
     def get_redirect_url(self, request):
         return reverse('oauth2:redirect')
 
+    def has_consent(self, request, client, client_data):
+        if not constants.REMEMBER_CONSENT:
+            return False
+        consented = Consent.objects.get_scope(request.user, client)
+        return bool(consented) and scopes.check(client_data['scope'], consented)
+
+    def save_consent(self, request, client, form, client_data):
+        if constants.REMEMBER_CONSENT:
+            Consent.objects.grant(request.user, client, form.cleaned_data['scope'])
+
     def save_authorization(self, request, client, form, client_data):
 
         grant = form.save(commit=False)
@@ -95,7 +195,7 @@ class Authorize(Authorize, OAuth2AccessTokenMixin):
         grant.user = request.user
         grant.client = client
         grant.redirect_uri = client_data.get('redirect_uri', '')
-        grant.save()
+        get_grant_store().save(grant)
         return grant.code
 
 
@@ -116,11 +216,81 @@ class AccessTokenView(AccessTokenView, OAuth2AccessTokenMixin):
         *or* the :attr:`grant_types` list.
     """
     authentication = (
-        BasicClientBackend,
-        RequestParamsClientBackend,
-        PublicPasswordBackend,
+        DispatchingClientBackend,
     )
 
+    def get_handler(self, grant_type):
+        handler = super(AccessTokenView, self).get_handler(grant_type)
+
+        # Run each grant, including refresh token rotation and grant
+        # invalidation, in a single transaction.
+        if handler is not None:
+            handler = self.replay_idempotent_requests(transaction.atomic(handler))
+        return handler
+
+    def get_request_fingerprint(self, data):
+        # Requests carry passwords and client secrets, so the fingerprint is
+        # keyed with the SECRET_KEY instead of being a plain digest that could
+        # be brute-forced by anyone able to read the cache.
+        items = sorted((key, data.getlist(key)) for key in data)
+        return salted_hmac('provider.oauth2.views.AccessTokenView', json.dumps(items)).hexdigest()
+
+    def replay_idempotent_requests(self, handler):
+        """
+        Wrap ``handler`` so that the successful response to a request with an
+        ``Idempotency-Key`` header is stored for
+        :attr:`provider.constants.IDEMPOTENCY_KEY_TIMEOUT` seconds and
+        returned, without touching the database, when the client sends the
+        same request with the same key again. A retry arriving while the first
+        request is still handled is answered with a *409* error.
+        """
+        if not idempotency_cache.enabled:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(request, data, client):
+            idempotency_key = request.META.get('HTTP_IDEMPOTENCY_KEY')
+            if not idempotency_key:
+                return handler(request, data, client)
+
+            if len(idempotency_key) > 255:
+                raise OAuthError({
+                    'error': 'invalid_request',
+                    'error_description': _("The Idempotency-Key header is too long.")})
+
+            fingerprint = self.get_request_fingerprint(data)
+            entry = idempotency_cache.get(client.client_id, idempotency_key)
+
+            if entry is None:
+                if idempotency_cache.reserve(client.client_id, idempotency_key, fingerprint):
+                    try:
+                        response = handler(request, data, client)
+                    except Exception:
+                        idempotency_cache.delete(client.client_id, idempotency_key)
+                        raise
+                    if response.status_code == 200:
+                        idempotency_cache.set(client.client_id, idempotency_key, fingerprint, response)
+                    else:
+                        idempotency_cache.delete(client.client_id, idempotency_key)
+                    return response
+
+                # Lost the race for the key.
+                entry = idempotency_cache.get(client.client_id, idempotency_key)
+
+            if entry is not None and entry[0] != fingerprint:
+                raise OAuthError({
+                    'error': 'invalid_request',
+                    'error_description': _("The Idempotency-Key was used for a different request.")})
+
+            if entry is None or entry[1] is None:
+                return self.error_response({
+                    'error': 'invalid_request',
+                    'error_description': _("A request with this Idempotency-Key is in progress.")}, status=409)
+
+            return HttpResponse(entry[3], status=entry[1], content_type=entry[2])
+
+        return wrapper
+
     def get_authorization_code_grant(self, request, data, client):
         form = AuthorizationCodeGrantForm(data, client=client)
         if not form.is_valid():
@@ -145,12 +315,25 @@ class AccessTokenView(AccessTokenView, OAuth2AccessTokenMixin):
             raise OAuthError(form.errors)
         return form.cleaned_data
 
+    def client_credentials(self, request, data, client):
+        if not (client_credentials_token_cache.enabled and client.reuse_client_credentials_token):
+            return super(AccessTokenView, self).client_credentials(request, data, client)
+
+        data = self.get_client_credentials_grant(request, data, client)
+        at = client_credentials_token_cache.get(client.pk, data.get('scope'))
+
+        if at is None:
+            at, rt = self.get_access_and_refresh_tokens(
+                request, client.user, data.get('scope'), client,
+                reuse_existing_access_token=constants.SINGLE_ACCESS_TOKEN, create_refresh_token=False)
+            client_credentials_token_cache.set(at)
+
+        return self.access_token_response(at)
+
     def invalidate_grant(self, grant):
-        if constants.DELETE_EXPIRED:
-            grant.delete()
-        else:
-            grant.expires = now() - timedelta(days=1)
-            grant.save()
+        if not get_grant_store().invalidate(grant):
+            # Exchanged by a concurrent request.
+            raise OAuthError({'error': 'invalid_grant'})
 
 
 class AccessTokenDetailView(View):
@@ -160,6 +343,10 @@ class AccessTokenDetailView(View):
     A successful response has HTTP status 200 and includes a JSON object containing the username, scope, and expiration
      date-time (in ISO 8601 format, UTC timezone) for the access token.
 
+    Successful responses carry an ``ETag`` and may be cached privately for
+    :attr:`provider.constants.ACCESS_TOKEN_DETAIL_MAX_AGE` seconds, never beyond the token's expiry. Requests with a
+    matching ``If-None-Match`` header get HTTP 304. Error responses are never cached.
+
     Example
         GET /access_token/abc123/
 
@@ -169,17 +356,94 @@ class AccessTokenDetailView(View):
             expires: "2015-04-01T08:41:51"
         }
     """
+    JSON_CONTENT_TYPE = 'application/json'
 
-    def get(self, request, *args, **kwargs):
-        JSON_CONTENT_TYPE = 'application/json'
+    def get_token_details(self, access_token):
+        return {
+            'username': access_token.user.username,
+            'scope': access_token.get_scope_display(),
+            'expires': access_token.expires.isoformat()
+        }
 
+    def get(self, request, *args, **kwargs):
         try:
             access_token = AccessToken.objects.get_token(kwargs['token'])
-            content = {
-                'username': access_token.user.username,
-                'scope': access_token.get_scope_display(),
-                'expires': access_token.expires.isoformat()
-            }
-            return HttpResponse(json.dumps(content), content_type=JSON_CONTENT_TYPE)
         except ObjectDoesNotExist:
-            return HttpResponseBadRequest(json.dumps({'error': 'invalid_token'}), content_type=JSON_CONTENT_TYPE)
+            response = HttpResponseBadRequest(json.dumps({'error': 'invalid_token'}),
+                                              content_type=self.JSON_CONTENT_TYPE)
+            response['Cache-Control'] = 'no-store'
+            return response
+
+        content = self.get_token_details(access_token)
+        response = HttpResponse(json.dumps(content), content_type=self.JSON_CONTENT_TYPE)
+
+        max_age = max(0, min(constants.ACCESS_TOKEN_DETAIL_MAX_AGE, access_token.get_expire_delta()))
+        patch_cache_control(response, private=True, max_age=max_age)
+        set_response_etag(response)
+
+        return get_conditional_response(request, etag=response['ETag'], response=response)
+
+
+class AccessTokenBatchDetailView(AccessTokenDetailView):
+    """
+    This view returns info about several access tokens at once. Tokens are passed as repeated ``token`` parameters,
+    either in the query string or the request body, and resolved with a single query. At most
+    :attr:`provider.constants.TOKEN_BATCH_MAX_SIZE` tokens are accepted per request; larger or empty batches get
+    HTTP 400.
+
+    The response maps each token to the same details :class:`AccessTokenDetailView` returns, or to an
+    ``invalid_token`` error.
+
+    Example
+        GET /access_token/batch/?token=abc123&token=def456
+
+        {
+            abc123: {
+                username: "some-user",
+                scope: "read",
+                expires: "2015-04-01T08:41:51"
+            },
+            def456: {
+                error: "invalid_token"
+            }
+        }
+    """
+
+    def get_tokens(self, data):
+        tokens = data.getlist('token')
+
+        if not tokens:
+            raise OAuthError({
+                'error': 'invalid_request',
+                'error_description': _("No 'token' included in the request.")})
+
+        if len(tokens) > constants.TOKEN_BATCH_MAX_SIZE:
+            raise OAuthError({
+                'error': 'invalid_request',
+                'error_description': _("At most %d tokens are allowed per request.") % constants.TOKEN_BATCH_MAX_SIZE})
+
+        return tokens
+
+    def get_response(self, data):
+        try:
+            tokens = self.get_tokens(data)
+        except OAuthError as e:
+            return HttpResponseBadRequest(json.dumps(e.args[0]), content_type=self.JSON_CONTENT_TYPE)
+
+        access_tokens = AccessToken.objects.get_tokens(tokens)
+
+        content = {}
+        for token in tokens:
+            access_token = access_tokens.get(token)
+            if access_token is None:
+                content[token] = {'error': 'invalid_token'}
+            else:
+                content[token] = self.get_token_details(access_token)
+
+        return HttpResponse(json.dumps(content), content_type=self.JSON_CONTENT_TYPE)
+
+    def get(self, request, *args, **kwargs):
+        return self.get_response(request.GET)
+
+    def post(self, request, *args, **kwargs):
+        return self.get_response(request.POST)
@@ -0,0 +1,254 @@
+"""
+Storage for the state of an authorization flow while the resource owner goes
+through the :class:`provider.views.Capture`, :class:`provider.views.Authorize`
+and :class:`provider.views.Redirect` views.
+
+The state of a flow is kept as a single ``dict``. Views read and change it
+through :func:`get_state`, :func:`set_state` and :func:`clear_state`; changes
+are written once per request by :func:`flush_state`, which
+:class:`provider.views.OAuthView` calls before returning the response. The
+store is configured with :attr:`provider.constants.STATE_STORE`.
+
+A flow is started with :func:`new_state`, so stores never continue a flow
+under an identifier they did not issue for it. The state is bound to the
+user who started the flow and ignored in requests of any other user.
+"""
+
+import six
+from django.core import signing
+from django.utils.module_loading import import_string
+
+from provider import constants
+from provider.oauth2.cache import get_cache, make_key
+from provider.utils import secure_token
+
+_STATE = '_oauth_state'
+_CHANGE = '_oauth_state_change'
+_NEW = '_oauth_state_new'
+
+_USER = 'user'
+
+_SAVE = 'save'
+_DELETE = 'delete'
+
+
+def get_state_store():
+    """
+    Return an instance of the state store configured by
+    :attr:`provider.constants.STATE_STORE`.
+    """
+    return import_string(constants.STATE_STORE)()
+
+
+def get_user_id(request):
+    """
+    Return the identifier the state of ``request`` is bound to.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or user.pk is None:
+        return None
+    return six.text_type(user.pk)
+
+
+def get_state(request):
+    """
+    Return the state of the authorization flow of ``request``. The state is
+    loaded once per request.
+    """
+    state = getattr(request, _STATE, None)
+    if state is None:
+        state = get_state_store().load(request) or {}
+        if state.get(_USER) != get_user_id(request):
+            # Started by another user, or planted in the user agent.
+            state = {}
+        setattr(request, _STATE, state)
+    return state
+
+
+def new_state(request):
+    """
+    Start a new authorization flow, discarding the state of any previous one.
+    """
+    setattr(request, _STATE, {_USER: get_user_id(request)})
+    setattr(request, _CHANGE, _SAVE)
+    setattr(request, _NEW, True)
+
+
+def set_state(request, key, value):
+    get_state(request)[key] = value
+    setattr(request, _CHANGE, _SAVE)
+
+
+def clear_state(request):
+    get_state(request).clear()
+    setattr(request, _CHANGE, _DELETE)
+
+
+def flush_state(request, response):
+    """
+    Write the changes made to the state of ``request``, if any.
+    """
+    change = getattr(request, _CHANGE, None)
+    if change == _SAVE:
+        state = get_state(request)
+        state[_USER] = get_user_id(request)
+        get_state_store().save(request, response, state, new=getattr(request, _NEW, False))
+    elif change == _DELETE:
+        get_state_store().delete(request, response)
+    setattr(request, _CHANGE, None)
+    setattr(request, _NEW, False)
+
+
+class StateStore(object):
+    """
+    Base class of state stores. Implementations must implement:
+
+    * :meth:`load`
+    * :meth:`save`
+    * :meth:`delete`
+    """
+
+    def load(self, request):
+        """
+        Return the stored state of the flow of ``request`` or ``None``.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def save(self, request, response, state, new=False):
+        """
+        Store ``state``. Stores relying on cookies set them on ``response``.
+        ``new`` is ``True`` for the first save of a flow, when stores must not
+        reuse an identifier sent by the user agent.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+    def delete(self, request, response):
+        """
+        Remove the stored state.
+        """
+        raise NotImplementedError  # pragma: no cover
+
+
+class SessionStateStore(StateStore):
+    """
+    Default state store, keeping the state in the session under
+    :attr:`provider.constants.SESSION_KEY`.
+
+    Earlier versions stored each value under its own
+    ``<SESSION_KEY>:<key>`` session key. Such flows are loaded into a single
+    state and their keys removed, so that flows in progress survive an
+    upgrade.
+    """
+    legacy_keys = ('params', 'code', 'client')
+
+    def get_legacy_key(self, key):
+        return '%s:%s' % (constants.SESSION_KEY, key)
+
+    def load(self, request):
+        state = request.session.get(constants.SESSION_KEY)
+        if state is None:
+            state = self.load_legacy(request)
+        return state
+
+    def load_legacy(self, request):
+        state = {}
+        for key in self.legacy_keys:
+            legacy_key = self.get_legacy_key(key)
+            if legacy_key in request.session:
+                state[key] = request.session.pop(legacy_key)
+
+        if not state:
+            return None
+
+        if isinstance(state.get('client'), dict):
+            # Clients were stored serialized.
+            state['client'] = state['client'].get('client_id')
+
+        # The session belongs to the user who started the flow.
+        state[_USER] = get_user_id(request)
+        request.session[constants.SESSION_KEY] = state
+        return state
+
+    def save(self, request, response, state, new=False):
+        self.delete_legacy(request)
+        request.session[constants.SESSION_KEY] = state
+
+    def delete(self, request, response):
+        self.delete_legacy(request)
+        request.session.pop(constants.SESSION_KEY, None)
+
+    def delete_legacy(self, request):
+        for key in self.legacy_keys:
+            request.session.pop(self.get_legacy_key(key), None)
+
+
+class CookieStateStore(StateStore):
+    """
+    Base class of stores keeping the state, or a reference to it, in the
+    cookie named by :attr:`provider.constants.STATE_COOKIE_NAME`.
+    """
+
+    def set_cookie(self, request, response, value):
+        response.set_cookie(constants.STATE_COOKIE_NAME, value, max_age=constants.STATE_TIMEOUT,
+                            secure=request.is_secure(), httponly=True)
+
+    def delete_cookie(self, response):
+        response.delete_cookie(constants.STATE_COOKIE_NAME)
+
+
+class CacheStateStore(CookieStateStore):
+    """
+    State store keeping the state in the provider cache for
+    :attr:`provider.constants.STATE_TIMEOUT` seconds, under a random
+    identifier sent to the user agent in a cookie. Needs no session.
+    """
+    prefix = 'authorization_state'
+    serializer = signing.JSONSerializer
+
+    def load(self, request):
+        state_id = request.COOKIES.get(constants.STATE_COOKIE_NAME)
+        if not state_id:
+            return None
+        value = get_cache().get(make_key(self.prefix, state_id))
+        return self.serializer().loads(value) if value is not None else None
+
+    def save(self, request, response, state, new=False):
+        state_id = request.COOKIES.get(constants.STATE_COOKIE_NAME)
+        if new:
+            # Never continue under an identifier that may have been planted.
+            if state_id:
+                get_cache().delete(make_key(self.prefix, state_id))
+            state_id = None
+        state_id = state_id or secure_token(16)
+        get_cache().set(make_key(self.prefix, state_id), self.serializer().dumps(state), constants.STATE_TIMEOUT)
+        self.set_cookie(request, response, state_id)
+
+    def delete(self, request, response):
+        state_id = request.COOKIES.get(constants.STATE_COOKIE_NAME)
+        if state_id:
+            get_cache().delete(make_key(self.prefix, state_id))
+        self.delete_cookie(response)
+
+
+class SignedCookieStateStore(CookieStateStore):
+    """
+    State store keeping the whole state in a signed cookie, with no server
+    side storage at all. The state is signed, not encrypted, so the user agent
+    can read it.
+    """
+    salt = 'provider.state'
+
+    def load(self, request):
+        value = request.COOKIES.get(constants.STATE_COOKIE_NAME)
+        if not value:
+            return None
+        try:
+            return signing.loads(value, salt=self.salt, max_age=constants.STATE_TIMEOUT)
+        except signing.BadSignature:
+            return None
+
+    def save(self, request, response, state, new=False):
+        self.set_cookie(request, response, signing.dumps(state, salt=self.salt, compress=True))
+
+    def delete(self, request, response):
+        self.delete_cookie(response)
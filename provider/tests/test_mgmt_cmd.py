@@ -6,9 +6,12 @@ import unittest
 import uuid
 from datetime import datetime, timedelta
 
+import six
 from django.contrib.auth.models import User
 from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import QuerySet
 
 from provider import constants
 from provider.management.commands.delete_expired_grant_tokens import Command
@@ -113,3 +116,53 @@ class TestDeleteExpiredAccessTokens(_TokenDeletionTestCase):
         call_command(self.command_name, chunk_size=2)
         self.assertEqual(self.model.objects.all().count(), 10)
         self.assertEqual(RefreshToken.objects.all().count(), 10)
+
+
+class BenchmarkTokensTestCase(unittest.TestCase):
+    """
+    Tests for the `benchmark_tokens` management command.
+    """
+
+    def test_benchmark(self):
+        out = six.StringIO()
+        call_command('benchmark_tokens', iterations=10, pool_size=5, stdout=out)
+        output = out.getvalue()
+        for name in ('legacy_long_token', 'secure_token', 'TokenPool.get'):
+            self.assertIn(name, output)
+
+    def test_invalid_iterations(self):
+        with self.assertRaises(CommandError):
+            call_command('benchmark_tokens', iterations=0)
+
+
+class CreatePartialIndexesTestCase(unittest.TestCase):
+    """
+    Tests for the `create_partial_indexes` management command.
+    """
+
+    def setUp(self):
+        super(CreatePartialIndexesTestCase, self).setUp()
+        self.addCleanup(call_command, 'create_partial_indexes', drop=True, stdout=six.StringIO())
+
+    def get_index_names(self):
+        with connection.cursor() as cursor:
+            return set(connection.introspection.get_constraints(cursor, RefreshToken._meta.db_table))
+
+    def test_create_and_drop(self):
+        call_command('create_partial_indexes', stdout=six.StringIO())
+        self.assertIn('oauth2_refreshtoken_live_token', self.get_index_names())
+
+        # Creating them again is harmless.
+        call_command('create_partial_indexes', stdout=six.StringIO())
+
+        call_command('create_partial_indexes', drop=True, stdout=six.StringIO())
+        self.assertNotIn('oauth2_refreshtoken_live_token', self.get_index_names())
+
+    @unittest.skipUnless(connection.vendor == 'sqlite', 'Checks the SQLite query plan.')
+    @unittest.skipUnless(hasattr(QuerySet, 'explain'), 'QuerySet.explain() needs Django 2.1.')
+    def test_live_token_lookup_uses_partial_index(self):
+        call_command('create_partial_indexes', stdout=six.StringIO())
+
+        plan = RefreshToken.objects.filter(token='abc', expired=False).explain()
+
+        self.assertIn('oauth2_refreshtoken_live_token', plan)
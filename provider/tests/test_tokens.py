@@ -0,0 +1,81 @@
+"""
+Test cases for the self-checking token format in the provider.tokens module
+"""
+
+import uuid
+from datetime import timedelta
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from mock import patch
+
+from provider import tokens
+from provider.utils import now
+
+
+@patch('provider.constants.CHECKED_TOKENS', True)
+class CheckedTokenTestCase(TestCase):
+    def test_valid_token(self):
+        token = tokens.checked_token(now() + timedelta(hours=1))
+        self.assertTrue(tokens.is_checked_token(token))
+        self.assertTrue(tokens.check_token(token))
+
+    def test_token_without_expiry(self):
+        self.assertTrue(tokens.check_token(tokens.checked_token()))
+
+    def test_expired_token(self):
+        token = tokens.checked_token(now() - timedelta(seconds=1))
+        self.assertFalse(tokens.check_token(token))
+
+    def test_forged_token(self):
+        token = tokens.checked_token(now() - timedelta(seconds=1))
+        # Push the expiry far into the future without updating the HMAC.
+        forged = token[:34] + 'ffffffff' + token[42:]
+        self.assertFalse(tokens.check_token(forged))
+
+    def test_malformed_token(self):
+        self.assertFalse(tokens.check_token(tokens.CHECKED_TOKEN_PREFIX + 'abc'))
+
+    def test_legacy_token(self):
+        self.assertTrue(tokens.check_token('da39a3ee5e6b4b0d3255bfef95601890afd80709'))
+
+    def test_token_is_url_safe(self):
+        self.assertRegexpMatches(tokens.checked_token(now()), r'^\w+$')
+
+
+@patch('provider.constants.SIGNED_TOKENS', True)
+class SignedTokenTestCase(TestCase):
+    def test_verify(self):
+        expires = now() + timedelta(hours=1)
+        token = tokens.signed_token(12, 3, 6, expires)
+
+        claims = tokens.verify_signed_token(token)
+        self.assertEqual(claims[:3], (12, 3, 6))
+        self.assertEqual(claims.expires, expires.replace(microsecond=0))
+        self.assertTrue(tokens.check_token(token))
+
+    def test_expired(self):
+        token = tokens.signed_token(12, 3, 6, now() - timedelta(seconds=1))
+        self.assertIsNone(tokens.verify_signed_token(token))
+        self.assertFalse(tokens.check_token(token))
+
+    def test_forged_claims(self):
+        token = tokens.signed_token(12, 3, 6, now() + timedelta(hours=1))
+        forged = token.replace('s1_c_', 's1_d_', 1)
+        self.assertIsNone(tokens.verify_signed_token(forged))
+
+    def test_key_setting(self):
+        token = tokens.signed_token(12, 3, 6, now() + timedelta(hours=1))
+        with patch('provider.constants.SIGNED_TOKEN_KEY', 'other-key'):
+            self.assertIsNone(tokens.verify_signed_token(token))
+
+    def test_malformed(self):
+        self.assertIsNone(tokens.verify_signed_token('s1_abc'))
+        self.assertIsNone(tokens.verify_signed_token('abc'))
+
+    def test_token_is_url_safe(self):
+        self.assertRegexpMatches(tokens.signed_token(12, 3, 6, now()), r'^\w+$')
+
+    def test_non_integer_user_id(self):
+        with self.assertRaises(ImproperlyConfigured):
+            tokens.signed_token(uuid.uuid4(), 3, 6, now())
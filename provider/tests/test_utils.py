@@ -2,10 +2,12 @@
 Test cases for functionality provided by the provider.utils module
 """
 
+import re
 from datetime import datetime, date
 
 from django.db import models
 from django.test import TestCase
+from mock import patch
 
 from provider import utils
 
@@ -51,3 +53,36 @@ class UtilsTestCase(TestCase):
 
         instance = utils.deserialize_instance(ParentModel, data)
         self.assertEqual(instance.child, None)
+
+
+class TokenGeneratorTestCase(TestCase):
+    def test_secure_token(self):
+        token = utils.secure_token(16)
+        self.assertEqual(len(token), 32)
+        self.assertTrue(re.match(r'^[0-9a-f]+$', token))
+        self.assertNotEqual(token, utils.secure_token(16))
+
+    @patch('provider.constants.TOKEN_BYTES', None)
+    def test_legacy_tokens(self):
+        self.assertEqual(len(utils.long_token()), 40)
+        self.assertEqual(len(utils.short_token()), 20)
+
+    @patch('provider.constants.TOKEN_BYTES', 32)
+    def test_configured_length(self):
+        self.assertEqual(len(utils.long_token()), 64)
+        self.assertEqual(len(utils.short_token()), 32)
+
+    @patch('provider.constants.TOKEN_BYTES', 16)
+    @patch('provider.constants.TOKEN_POOL_SIZE', 10)
+    def test_pooled_tokens(self):
+        tokens = set(utils.long_token() for _ in range(50))
+        self.assertEqual(len(tokens), 50)
+        self.assertTrue(all(len(token) == 32 for token in tokens))
+
+    def test_pool_discarded_after_fork(self):
+        pool = utils.TokenPool(16, 10)
+        pool.get()
+        pool._tokens.append('inherited')
+
+        with patch('provider.utils.os.getpid', return_value=-1):
+            self.assertNotEqual(pool.get(), 'inherited')
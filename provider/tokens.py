@@ -0,0 +1,178 @@
+"""
+Token formats that can be verified without touching the database.
+
+Self-checking tokens embed their expiry and a truncated HMAC so that
+malformed, forged or expired tokens are rejected before a lookup. Enable with
+:attr:`provider.constants.CHECKED_TOKENS`. Layout, all lower case hexadecimal
+after the prefix::
+
+    v1 | 32 random | 8 expiry epoch (0 = none) | 16 HMAC
+
+Signed tokens are self-contained: they carry the user id, client id, scope
+and expiry, signed with :attr:`provider.constants.SIGNED_TOKEN_KEY`, and can
+be verified with :func:`verify_signed_token` with no I/O at all. Enable with
+:attr:`provider.constants.SIGNED_TOKENS`. Fields are hexadecimal, so users and
+clients need integer primary keys, and are joined by underscores so the token
+stays URL safe. The HMAC is SHA-1::
+
+    s1 _ user id _ client id _ scope _ expiry epoch _ 16 random _ 40 HMAC
+
+Tokens starting with neither prefix are legacy tokens (see
+:func:`provider.utils.long_token`) and can only be validated by a lookup.
+"""
+
+import binascii
+import calendar
+import os
+import time
+from collections import namedtuple
+from datetime import datetime
+
+import six
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from provider import constants
+
+CHECKED_TOKEN_PREFIX = 'v1'
+
+_RANDOM_LENGTH = 32
+_EXPIRY_LENGTH = 8
+_MAC_LENGTH = 16
+_TOKEN_LENGTH = len(CHECKED_TOKEN_PREFIX) + _RANDOM_LENGTH + _EXPIRY_LENGTH + _MAC_LENGTH
+
+_KEY_SALT = 'provider.tokens.checked_token'
+
+SIGNED_TOKEN_PREFIX = 's1_'
+
+_SIGNED_KEY_SALT = 'provider.tokens.signed_token'
+
+SignedToken = namedtuple('SignedToken', ['user_id', 'client_id', 'scope', 'expires'])
+"""
+Claims carried by a signed token, as returned by :func:`verify_signed_token`.
+"""
+
+
+def _random_hex(length):
+    return binascii.hexlify(os.urandom(length // 2)).decode('ascii')
+
+
+def _mac(payload):
+    return salted_hmac(_KEY_SALT, payload).hexdigest()[:_MAC_LENGTH]
+
+
+def _epoch(expires):
+    if expires is None:
+        return 0
+    if timezone.is_naive(expires):
+        # Without USE_TZ, naive datetimes are in the default time zone.
+        expires = timezone.make_aware(expires, timezone.get_default_timezone())
+    return calendar.timegm(expires.utctimetuple())
+
+
+def _from_epoch(epoch):
+    expires = datetime.utcfromtimestamp(epoch).replace(tzinfo=timezone.utc)
+    if not settings.USE_TZ:
+        expires = timezone.make_naive(expires, timezone.get_default_timezone())
+    return expires
+
+
+def checked_token(expires=None):
+    """
+    Return a new self-checking token expiring at the ``expires`` datetime, or
+    never if ``expires`` is ``None``.
+    """
+    payload = '%s%s%08x' % (CHECKED_TOKEN_PREFIX, _random_hex(_RANDOM_LENGTH), _epoch(expires))
+    return payload + _mac(payload)
+
+
+def is_checked_token(token):
+    """
+    Return ``True`` if ``token`` claims to use the self-checking format.
+    """
+    return token.startswith(CHECKED_TOKEN_PREFIX)
+
+
+def _check_checked_token(token):
+    if len(token) != _TOKEN_LENGTH:
+        return False
+
+    payload, mac = token[:-_MAC_LENGTH], token[-_MAC_LENGTH:]
+    if not constant_time_compare(mac, _mac(payload)):
+        return False
+
+    try:
+        expires = int(payload[-_EXPIRY_LENGTH:], 16)
+    except ValueError:
+        return False
+
+    return expires == 0 or expires > time.time()
+
+
+def _signed_mac(payload):
+    key = constants.SIGNED_TOKEN_KEY or settings.SECRET_KEY
+    return salted_hmac(_SIGNED_KEY_SALT, payload, secret=key).hexdigest()
+
+
+def signed_token(user_id, client_id, scope, expires):
+    """
+    Return a new signed token carrying the given claims. ``user_id`` and
+    ``client_id`` are the integer primary keys of the user and client.
+    """
+    for pk in (user_id, client_id):
+        if not isinstance(pk, six.integer_types):
+            raise ImproperlyConfigured('OAUTH_SIGNED_TOKENS requires integer user and client primary keys, '
+                                       'got %r.' % pk)
+
+    payload = '%s%x_%x_%x_%x_%s' % (SIGNED_TOKEN_PREFIX, user_id, client_id, scope, _epoch(expires),
+                                    _random_hex(16))
+    return '%s_%s' % (payload, _signed_mac(payload))
+
+
+def is_signed_token(token):
+    """
+    Return ``True`` if ``token`` claims to be a signed token.
+    """
+    return token.startswith(SIGNED_TOKEN_PREFIX)
+
+
+def verify_signed_token(token):
+    """
+    Return the :class:`SignedToken` claims of a validly signed, unexpired
+    token or ``None`` otherwise. This does no I/O, so a token revoked before
+    its expiry still verifies.
+    """
+    if not token or not is_signed_token(token):
+        return None
+
+    payload, _, mac = token.rpartition('_')
+    if not constant_time_compare(mac, _signed_mac(payload)):
+        return None
+
+    try:
+        user_id, client_id, scope, expires, _ = [
+            int(field, 16) for field in payload[len(SIGNED_TOKEN_PREFIX):].split('_')]
+    except ValueError:
+        return None
+
+    if expires <= time.time():
+        return None
+
+    return SignedToken(user_id, client_id, scope, _from_epoch(expires))
+
+
+def check_token(token):
+    """
+    Return ``False`` if ``token`` uses the self-checking or signed format and
+    is malformed, forged or expired. Every other token may be valid and has to
+    be looked up.
+    """
+    if not token:
+        return True
+    if constants.SIGNED_TOKENS and is_signed_token(token):
+        return verify_signed_token(token) is not None
+    if constants.CHECKED_TOKENS and is_checked_token(token):
+        return _check_checked_token(token)
+    return True
@@ -1,5 +1,9 @@
+import binascii
 import hashlib
 import json
+import os
+import threading
+from collections import deque
 
 import shortuuid
 from django.conf import settings
@@ -10,14 +14,95 @@ from django.db.models.fields import (DateTimeField, DateField,
 from django.utils import dateparse, timezone
 from django.utils.encoding import force_bytes
 
+from provider import constants
 from provider.constants import EXPIRE_DELTA, EXPIRE_DELTA_PUBLIC, EXPIRE_CODE_DELTA
 
+try:
+    from secrets import token_bytes
+except ImportError:  # Python 2
+    token_bytes = os.urandom
+
 
 def now():
     return timezone.now()
 
 
-def short_token():
+def secure_token(nbytes):
+    """
+    Return ``nbytes`` random bytes from the operating system's CSPRNG,
+    hex-encoded so that tokens are URL safe and match ``\\w+``.
+    """
+    return binascii.hexlify(token_bytes(nbytes)).decode('ascii')
+
+
+class TokenPool(object):
+    """
+    Pool of pre-generated :func:`secure_token` values for bursts of token
+    issuance. A background thread refills the pool whenever it drops below
+    half of ``size``; callers never wait for it and fall back to generating a
+    token directly when the pool is empty.
+
+    The pool is discarded after a fork, so that worker processes never hand
+    out the same tokens.
+    """
+
+    def __init__(self, nbytes, size):
+        self.nbytes = nbytes
+        self.size = size
+        self._pid = None
+        self._tokens = deque()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._tokens.clear()
+        self._refill.set()
+        thread = threading.Thread(target=self._run, name='provider-token-pool')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        pid = self._pid
+        while self._pid == pid:
+            self._refill.wait()
+            while len(self._tokens) < self.size:
+                self._tokens.append(secure_token(self.nbytes))
+            self._refill.clear()
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._start()
+
+        try:
+            token = self._tokens.popleft()
+        except IndexError:
+            token = secure_token(self.nbytes)
+
+        if len(self._tokens) < self.size // 2:
+            self._refill.set()
+        return token
+
+
+_token_pools = {}
+_token_pools_lock = threading.Lock()
+
+
+def _pooled_token(nbytes):
+    if not constants.TOKEN_POOL_SIZE:
+        return secure_token(nbytes)
+
+    key = (nbytes, constants.TOKEN_POOL_SIZE)
+    pool = _token_pools.get(key)
+    if pool is None:
+        with _token_pools_lock:
+            pool = _token_pools.setdefault(key, TokenPool(*key))
+    return pool.get()
+
+
+def legacy_short_token():
     """
     Generate a hash that can be used as an application identifier
     """
@@ -26,7 +111,7 @@ def short_token():
     return hash.hexdigest()[::2]
 
 
-def long_token():
+def legacy_long_token():
     """
     Generate a hash that can be used as an application secret
     """
@@ -35,6 +120,29 @@ def long_token():
     return hash.hexdigest()
 
 
+def short_token():
+    """
+    Generate a token that can be used as an application identifier. Uses
+    :func:`secure_token` with half of :attr:`provider.constants.TOKEN_BYTES`
+    bytes if set, :func:`legacy_short_token` otherwise.
+    """
+    if constants.TOKEN_BYTES:
+        return secure_token(max(1, constants.TOKEN_BYTES // 2))
+    return legacy_short_token()
+
+
+def long_token():
+    """
+    Generate a token that can be used as an application secret or access
+    token. Uses :func:`secure_token` with
+    :attr:`provider.constants.TOKEN_BYTES` bytes, optionally drawn from a
+    :class:`TokenPool`, if set, :func:`legacy_long_token` otherwise.
+    """
+    if constants.TOKEN_BYTES:
+        return _pooled_token(constants.TOKEN_BYTES)
+    return legacy_long_token()
+
+
 def get_token_expiry(public=True):
     """
     Return a datetime object indicating when an access token should expire.
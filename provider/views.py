@@ -1,5 +1,5 @@
+import hashlib
 import json
-import six
 from six.moves.urllib.parse import urlparse, ParseResult
 
 from django.core.exceptions import ObjectDoesNotExist
@@ -11,6 +11,7 @@ from django.views.generic.base import TemplateView
 
 from provider.oauth2.models import Client
 from provider import constants, scope
+from provider.state import clear_state, flush_state, get_state, new_state, set_state
 
 
 class OAuthError(Exception):
@@ -82,6 +83,23 @@ class AccessTokenMixin(object):
         """
         raise NotImplementedError  # pragma: no cover
 
+    def get_replayed_access_token(self, refresh_token):
+        """
+        Override to return the access token already issued in exchange for a
+        replayed ``refresh_token``, or ``None`` to issue new tokens.
+
+        :return: ``object`` - Access token or ``None``
+        """
+        return None
+
+    def set_refresh_token_successor(self, refresh_token, successor):
+        """
+        Override to record that ``successor`` was issued in exchange for the
+        invalidated ``refresh_token``.
+
+        :return None:
+        """
+
     def access_token_response_data(self, access_token, response_type=None, nonce=''):
         """
         Returns access token data as defined in :rfc:`5.1`.
@@ -136,6 +154,7 @@ class OAuthView(TemplateView):
         response = super(OAuthView, self).dispatch(request, *args, **kwargs)
         response['Cache-Control'] = 'no-store'
         response['Pragma'] = 'no-cache'
+        flush_state(request, response)
         return response
 
 
@@ -147,30 +166,57 @@ class Mixin(object):
 
     def get_data(self, request, key='params'):
         """
-        Return stored data from the session store.
+        Return stored data from the authorization state store, see
+        :mod:`provider.state`.
 
         :param key: `str` The key under which the data was stored.
         """
-        return request.session.get('%s:%s' % (constants.SESSION_KEY, key))
+        return get_state(request).get(key)
 
     def cache_data(self, request, data, key='params'):
         """
-        Cache data in the session store.
+        Cache data in the authorization state store. Changes are written once,
+        when the response is returned.
 
         :param request: :attr:`django.http.HttpRequest`
-        :param data: Arbitrary data to store.
+        :param data: Arbitrary JSON serializable data to store.
         :param key: `str` The key under which to store the data.
         """
-        request.session['%s:%s' % (constants.SESSION_KEY, key)] = data
+        set_state(request, key, data)
 
     def clear_data(self, request):
         """
-        Clear all OAuth related data from the session store.
+        Clear all OAuth related data from the authorization state store.
+        """
+        clear_state(request)
+
+    def get_request_fingerprint(self, client, data):
+        """
+        Return a digest of the captured authorization request ``data`` and of
+        the client settings it is validated against.
         """
-        for key in list(request.session.keys()):
-            session_key = constants.SESSION_KEY
-            if isinstance(key, six.string_types) and key.startswith(session_key):
-                del request.session[key]
+        fingerprint = json.dumps([client.client_id, client.redirect_uri, data], sort_keys=True)
+        return hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+
+    def cache_validated_data(self, request, client, data, cleaned_data):
+        """
+        Remember that the captured authorization request ``data`` of
+        ``client`` validated to ``cleaned_data``.
+        """
+        self.cache_data(request, {
+            'fingerprint': self.get_request_fingerprint(client, data),
+            'data': cleaned_data,
+        }, 'validated')
+
+    def get_validated_data(self, request, client, data):
+        """
+        Return the data remembered by :meth:`cache_validated_data`, or
+        ``None`` if the captured request or the client changed since.
+        """
+        validated = self.get_data(request, 'validated')
+        if validated and validated['fingerprint'] == self.get_request_fingerprint(client, data):
+            return validated['data']
+        return None
 
     def authenticate(self, request):
         """
@@ -210,7 +256,20 @@ class Capture(OAuthView, Mixin):
         """
         raise NotImplementedError  # pragma: no cover
 
+    def validate_request(self, request, data):
+        """
+        Override to validate the captured authorization request right away
+        and return a ``(client, cleaned data)`` tuple, or ``None`` if it is
+        not valid. The result is stored along with the captured data, so that
+        :class:`Authorize` does not validate the request again. Invalid
+        requests are reported by :class:`Authorize`.
+
+        :return: ``tuple`` or ``None``
+        """
+        return None
+
     def handle(self, request, data):
+        new_state(request)
         self.cache_data(request, data)
 
         if constants.ENFORCE_SECURE and not request.is_secure():
@@ -222,6 +281,11 @@ class Capture(OAuthView, Mixin):
                 },
                 status=400)
 
+        validated = self.validate_request(request, data)
+        if validated is not None:
+            client, cleaned_data = validated
+            self.cache_validated_data(request, client, data, cleaned_data)
+
         return HttpResponseRedirect(self.get_redirect_url(request))
 
     def get(self, request):
@@ -299,8 +363,25 @@ class Authorize(OAuthView, Mixin, AccessTokenMixin):
         """
         raise NotImplementedError  # pragma: no cover
 
+    def has_consent(self, request, client, client_data):
+        """
+        Override to return ``True`` if the resource owner already approved
+        the request described by ``client_data``, in which case no
+        authorization form is shown.
+        """
+        return False
+
+    def save_consent(self, request, client, form, client_data):
+        """
+        Override to remember that the resource owner approved the request
+        with the given authorization ``form``.
+        """
+
     def _validate_client(self, request, data):
         """
+        A request validated by :meth:`Capture.validate_request` is not
+        validated again, unless the captured parameters or the client changed.
+
         :return: ``tuple`` - ``(client or False, data or error)``
         """
         client = self.get_client(data.get('client_id'))
@@ -311,6 +392,11 @@ class Authorize(OAuthView, Mixin, AccessTokenMixin):
                 'error_description': _("An unauthorized client tried to access your resources.")
             })
 
+        validated = self.get_validated_data(request, client, data)
+
+        if validated is not None:
+            return client, validated
+
         form = self.get_request_form(client, data)
 
         if not form.is_valid():
@@ -385,6 +471,15 @@ class Authorize(OAuthView, Mixin, AccessTokenMixin):
         except OAuthError as e:
             return self.error_response(request, e.args[0], status=400)
 
+        consented = post_data is None and self.has_consent(request, client, data)
+        if consented:
+            # Approved before, act as if the resource owner approved again.
+            post_data = {
+                'authorize': True,
+                'scope': scope.names(data['scope']),
+                'nonce': data.get('nonce') or '',
+            }
+
         authorization_form = self.get_authorization_form(request, client, post_data, data)
 
         if not (authorization_form.is_bound and authorization_form.is_valid()):
@@ -407,6 +502,9 @@ class Authorize(OAuthView, Mixin, AccessTokenMixin):
 
             return HttpResponseRedirect(url)
 
+        if not consented:
+            self.save_consent(request, client, authorization_form, data)
+
         if 'token' in data['response_type']:
             try:
                 return self.get_implicit_response(request, client)
@@ -416,10 +514,12 @@ class Authorize(OAuthView, Mixin, AccessTokenMixin):
         code = self.save_authorization(request, client, authorization_form, data)
 
         # be sure to serialize any objects that aren't natively json
-        # serializable because these values are stored as session data
+        # serializable because these values are stored as session data. The
+        # client is stored by reference, which keeps its secret out of the
+        # state store.
         self.cache_data(request, data)
         self.cache_data(request, code, "code")
-        self.cache_data(request, client.serialize(), "client")
+        self.cache_data(request, client.client_id, "client")
 
         return HttpResponseRedirect(self.get_redirect_url(request))
 
@@ -445,14 +545,22 @@ class Redirect(OAuthView, Mixin):
         kwargs.setdefault('content_type', 'application/json')
         return HttpResponse(json.dumps(error), status=status, **kwargs)
 
+    def get_client(self, client_id):
+        """
+        Return the client stored by :class:`Authorize` or ``None``.
+        """
+        if not client_id:
+            return None
+        try:
+            return Client.objects.get_by_client_id(client_id)
+        except Client.DoesNotExist:
+            return None
+
     def get(self, request):
         data = self.get_data(request)
         code = self.get_data(request, "code")
         error = self.get_data(request, "error")
-        client = self.get_data(request, "client")
-
-        # client must be properly deserialized to become a valid instance
-        client = Client.deserialize(client)
+        client = self.get_client(self.get_data(request, "client"))
 
         # this is an edge case that is caused by making a request with no data
         # it should only happen if this view is called manually, out of the
@@ -561,7 +669,8 @@ class AccessToken(OAuthView, Mixin, AccessTokenMixin):
     def invalidate_grant(self, grant):
         """
         Override to handle grant invalidation. A grant is invalidated right
-        after creating an access token from it.
+        before creating an access token from it. Raise :class:`OAuthError` if
+        the grant was already used.
 
         :return None:
         """
@@ -592,6 +701,10 @@ class AccessToken(OAuthView, Mixin, AccessTokenMixin):
         """
         grant = self.get_authorization_code_grant(request, request.POST, client)
 
+        # Consume the grant first, so a concurrent exchange of the same code
+        # fails before issuing any tokens.
+        self.invalidate_grant(grant)
+
         kwargs = {
             'request': request,
             'user': grant.user,
@@ -601,8 +714,6 @@ class AccessToken(OAuthView, Mixin, AccessTokenMixin):
         }
         at, rt = self.get_access_and_refresh_tokens(**kwargs)
 
-        self.invalidate_grant(grant)
-
         nonce = grant.nonce
         return self.access_token_response(at, nonce)
 
@@ -612,6 +723,10 @@ class AccessToken(OAuthView, Mixin, AccessTokenMixin):
         """
         rt = self.get_refresh_token_grant(request, data, client)
 
+        at = self.get_replayed_access_token(rt)
+        if at is not None:
+            return self.access_token_response(at)
+
         # this must be called first in case we need to purge expired tokens
         self.invalidate_refresh_token(rt)
         self.invalidate_access_token(rt.access_token)
@@ -622,7 +737,8 @@ class AccessToken(OAuthView, Mixin, AccessTokenMixin):
             'scope': rt.access_token.scope,
             'client': client,
         }
-        at, rt = self.get_access_and_refresh_tokens(**kwargs)
+        at, new_rt = self.get_access_and_refresh_tokens(**kwargs)
+        self.set_refresh_token_successor(rt, new_rt)
 
         return self.access_token_response(at)
 